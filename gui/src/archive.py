@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+'''
+Archive format for finished recordings
+--------------------------------------
+
+Recordings (recordfile) are converted into compressed archives (.mpa) of
+chunks of a fixed duration (CHUNKTIME). Within a chunk the times are stored
+as microsecond differences and the ADC values XOR-ed with the previous pulse
+(they hardly change between pulses), per channel, compressed with zlib or
+lzma. Times are kept with a resolution of one microsecond.
+
+    archive header: magic 'MPA3', version, codec, chunk time,
+                    followed by the header of the recording (settings, calibration)
+    chunks:         compressed (time differences, XOR-ed ADC values)
+    footer:         per chunk start/end time, count, offset, size and the
+                    min/max/mean of the 12 ADC values
+    trailer:        footer offset, number of chunks, magic 'MPAE'
+
+The footer alone answers summary queries over a time range (per chunk: all
+chunks touching the range count); read() decompresses only the chunks in the
+range.
+
+Transcoding from the command line (one file per worker process):
+
+    python archive.py -j 4 -o archive recordings/*.rec
+'''
+import os
+import sys
+import lzma
+import zlib
+import struct
+import optparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pulsebuffer import ADCVALUES
+from recordfile import RecordReader, HEADERSIZE, HEADER
+
+MAGIC = b'MPA3'
+ENDMAGIC = b'MPAE'
+VERSION = 1
+EXTENSION = '.mpa'
+CHUNKTIME = 60.0                        # seconds per chunk
+START = struct.Struct('<4sHBd')         # magic, version, codec, chunk time
+TRAILER = struct.Struct('<QI4s')        # footer offset, chunks, end magic
+FOOTERTYPE = np.dtype([('start', '<f8'), ('end', '<f8'), ('count', '<u4'),
+                       ('offset', '<u8'), ('size', '<u4'),
+                       ('min', 'u1', (ADCVALUES,)), ('max', 'u1', (ADCVALUES,)),
+                       ('mean', '<f4', (ADCVALUES,))])
+
+ZLIB = 1
+LZMA = 2
+CODECS = {'zlib': ZLIB, 'lzma': LZMA}
+
+
+def _compress(codec, data):
+    ''' compress a chunk '''
+    if codec == LZMA:
+        return lzma.compress(data, preset=6)
+    return zlib.compress(data, 9)
+
+
+def _decompress(codec, data):
+    ''' decompress a chunk '''
+    if codec == LZMA:
+        return lzma.decompress(data)
+    return zlib.decompress(data)
+
+
+def encodeChunk(times, adc, codec = ZLIB):
+    ''' Compressed bytes of one chunk; times in microseconds relative to its first time '''
+    micro = np.round(times * 1e6).astype('<i8')
+    deltas = np.diff(micro, prepend=micro[:1])
+    xored = adc.copy()
+    xored[1:] ^= adc[:-1]
+    return _compress(codec, deltas.tobytes() + np.ascontiguousarray(xored.T).tobytes())
+
+
+def decodeChunk(data, start, count, codec = ZLIB):
+    ''' The (times, adc) arrays of one chunk (times with microsecond resolution) '''
+    raw = _decompress(codec, data)
+    micro = np.cumsum(np.frombuffer(raw, dtype='<i8', count=count)) + round(start * 1e6)
+    times = micro / 1e6
+    xored = np.frombuffer(raw, dtype=np.uint8, offset=8 * count).reshape(ADCVALUES, count).T
+    return times, np.bitwise_xor.accumulate(xored, axis=0)
+
+
+class ArchiveWriter(object):
+    ''' Writing of an archive, chunk by chunk '''
+
+    def __init__(self, filename, recordheader, codec = ZLIB, chunktime = CHUNKTIME):
+        ''' Create the archive; recordheader: the HEADERSIZE bytes of the recording '''
+        self.codec = codec
+        self.chunktime = chunktime
+        self._footers = []
+        self._file = open(filename, 'wb')
+        self._file.write(START.pack(MAGIC, VERSION, codec, chunktime))
+        self._file.write(bytes(recordheader[:HEADERSIZE]))
+
+
+    def addChunk(self, times, adc):
+        ''' Compress and write the records of one chunk '''
+        if len(times) == 0:
+            return
+        data = encodeChunk(times, adc, self.codec)
+        footer = np.zeros(1, dtype=FOOTERTYPE)[0]
+        footer['start'] = times[0]
+        footer['end'] = times[-1]
+        footer['count'] = len(times)
+        footer['offset'] = self._file.tell()
+        footer['size'] = len(data)
+        footer['min'] = adc.min(axis=0)
+        footer['max'] = adc.max(axis=0)
+        footer['mean'] = adc.mean(axis=0)
+        self._file.write(data)
+        self._footers.append(footer)
+
+
+    def close(self):
+        ''' Write footer and trailer '''
+        offset = self._file.tell()
+        footers = np.array(self._footers, dtype=FOOTERTYPE)
+        self._file.write(footers.tobytes())
+        self._file.write(TRAILER.pack(offset, len(footers), ENDMAGIC))
+        self._file.close()
+
+
+class ArchiveReader(object):
+    ''' Range queries on an archive '''
+
+    def __init__(self, filename):
+        ''' Read the headers and the footer (not the chunks) '''
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        magic, self.version, self.codec, self.chunktime = START.unpack(self._file.read(START.size))
+        recordheader = self._file.read(HEADERSIZE)
+        self._file.seek(-TRAILER.size, os.SEEK_END)
+        offset, chunks, endmagic = TRAILER.unpack(self._file.read(TRAILER.size))
+        if magic != MAGIC or endmagic != ENDMAGIC:
+            self._file.close()
+            raise ValueError('%s is not a (complete) MilliPillar archive' % filename)
+        fields = HEADER.unpack_from(recordheader, 0)
+        self.starttime = fields[4]
+        self.voltages = fields[5:7]
+        self.timings = fields[7:12]
+        self.calibration = fields[12:18]
+        self._file.seek(offset)
+        self.chunks = np.frombuffer(self._file.read(chunks * FOOTERTYPE.itemsize), dtype=FOOTERTYPE)
+
+
+    def __len__(self):
+        ''' number of records '''
+        return int(self.chunks['count'].sum())
+
+
+    def __enter__(self):
+        ''' context manager: the reader itself '''
+        return self
+
+
+    def __exit__(self, *args):
+        ''' context manager: close at the end '''
+        self.close()
+
+
+    def _selected(self, begin, end):
+        ''' footers of the chunks touching begin <= time < end '''
+        return self.chunks[(self.chunks['end'] >= begin) & (self.chunks['start'] < end)]
+
+
+    def summary(self, begin, end):
+        ''' count, min, max and mean of the 12 ADC values from the footers only
+            (whole chunks: every chunk touching the range counts)
+        '''
+        chunks = self._selected(begin, end)
+        count = int(chunks['count'].sum())
+        if count == 0:
+            return {'count': 0, 'min': None, 'max': None, 'mean': None}
+        weights = chunks['count'].astype(np.float64)[:, np.newaxis]
+        return {'count': count,
+                'min': chunks['min'].min(axis=0),
+                'max': chunks['max'].max(axis=0),
+                'mean': (chunks['mean'] * weights).sum(axis=0) / count}
+
+
+    def read(self, begin, end):
+        ''' The (times, adc) arrays of the records with begin <= time < end '''
+        times = []
+        adc = []
+        for chunk in self._selected(begin, end):
+            self._file.seek(int(chunk['offset']))
+            chunktimes, chunkadc = decodeChunk(self._file.read(int(chunk['size'])),
+                                               chunk['start'], int(chunk['count']), self.codec)
+            inside = (chunktimes >= begin) & (chunktimes < end)
+            times.append(chunktimes[inside])
+            adc.append(chunkadc[inside])
+        if not times:
+            return np.zeros(0), np.zeros((0, ADCVALUES), dtype=np.uint8)
+        return np.concatenate(times), np.concatenate(adc)
+
+
+    def close(self):
+        ''' close the archive '''
+        self._file.close()
+
+
+def transcode(recording, outdir = None, codec = ZLIB, chunktime = CHUNKTIME):
+    ''' Convert one finished recording into an archive; returns (archive name, ratio) '''
+    base = os.path.splitext(os.path.basename(recording))[0] + EXTENSION
+    archivename = os.path.join(outdir or os.path.dirname(recording), base)
+    with open(recording, 'rb') as infile:
+        recordheader = infile.read(HEADERSIZE)
+    with RecordReader(recording) as reader:
+        writer = ArchiveWriter(archivename, recordheader, codec, chunktime)
+        if len(reader):
+            bounds = np.arange(reader.times[0], reader.times[-1] + chunktime, chunktime)
+            edges = np.searchsorted(reader.times, bounds, side='left').tolist() + [len(reader)]
+            for first, last in zip(edges[:-1], edges[1:]):
+                writer.addChunk(reader.times[first:last], reader.adc[first:last])
+        writer.close()
+    ratio = os.path.getsize(recording) / max(1, os.path.getsize(archivename))
+    return archivename, ratio
+
+
+def _transcodeJob(args):
+    ''' worker process: one recording '''
+    return transcode(*args)
+
+
+def main():
+    ''' Transcode finished recordings into archives, one file per worker '''
+    parser = optparse.OptionParser(
+        usage = "%prog [options] recording.rec [recording.rec ...]",
+        description = "Convert finished MilliPillar recordings into compressed archives" )
+
+    parser.add_option("-o", "--outdir", dest = "outdir",
+                      help = "Directory for the archives (default: next to the recording)",
+                      default = None)
+    parser.add_option("-c", "--codec", dest = "codec",
+                      help = "Compression: zlib or lzma",
+                      default = "zlib")
+    parser.add_option("-t", "--chunktime", dest = "chunktime", type = "float",
+                      help = "Duration of a chunk in seconds",
+                      default = CHUNKTIME)
+    parser.add_option("-j", "--jobs", dest = "jobs", type = "int",
+                      help = "Number of worker processes",
+                      default = os.cpu_count())
+
+    (options, args) = parser.parse_args()
+
+    if not args or options.codec not in CODECS:
+        parser.print_help()
+        sys.exit(1)
+    if options.outdir:
+        os.makedirs(options.outdir, exist_ok=True)
+    jobs = [(recording, options.outdir, CODECS[options.codec], options.chunktime)
+            for recording in args]
+    with ProcessPoolExecutor(max_workers=options.jobs) as pool:
+        for recording, (archivename, ratio) in zip(args, pool.map(_transcodeJob, jobs)):
+            print('%s -> %s (%.1fx smaller)' % (recording, archivename, ratio))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+'''
+Asyncio measuring and setting Driver
+------------------------------------
+
+The asyncio counterpart of measuring.Measure: many stimulators can be driven
+from one event loop instead of one thread per port.
+
+    meas = AsyncMeasure('/dev/ttyUSB0')
+    await meas.open()
+    meas.SendRequest('ss')
+    async for line in meas:
+        ...
+
+Received lines are framed on CR, spurious characters (>127) are dropped and
+the lines are given stripped from CR/LF. Ports with a file descriptor are
+watched with the loop's reader callbacks; others (Windows, simulated ports)
+are polled every TIMEDELAY.
+'''
+import asyncio
+import traceback
+
+from measuring import RETRYCOUNT, openPort, frameLines
+
+
+class AsyncMeasure(object):
+    ''' classdocs asynchronous measurement
+    The communication interface to the embedded stimulator, as async iterator of lines
+    '''
+    TIMEDELAY = 0.005  # polling time for ports without a file descriptor
+
+    def __init__(self, port, baudrate = 38400):
+        ''' Constructor; the port is opened with open() '''
+        self.deviceName = port
+        self.baudrate = baudrate
+        self.bus = None
+        self.connected = False
+        self._loop = None
+        self._fd = None
+        self._poller = None
+        self._rxbuffer = bytearray()                    # received bytes, not yet a complete line
+        self._lines = asyncio.Queue()                   # complete lines; None at the end
+
+
+    async def open(self):
+        ''' Try to open the serial port (RETRYCOUNT times)
+            Returns True when connected
+        '''
+        self._loop = asyncio.get_running_loop()
+        retry = 0
+        while self.bus == None:
+            try:
+                self.bus = openPort(self.deviceName, self.baudrate, timeout=0)
+            except:
+                #All exceptions are trapped: not only serial, but also 'os' (wrong port name, etc)
+                retry += 1
+                if retry >= RETRYCOUNT:
+                    print("Serial didn't start, check configuration!")
+                    print(traceback.format_exc())
+                    return False
+                await asyncio.sleep(0.1)
+        self.connected = True
+        try:
+            self._fd = self.bus.fileno()
+        except:     # no fileno on Windows and on the simulated ports
+            self._fd = None
+        if self._fd is None:
+            self._poller = self._loop.create_task(self._poll())
+        else:
+            self._loop.add_reader(self._fd, self._getdata)
+        return True
+
+
+    def close(self):
+        ''' Stop reading and close the port; the iteration ends '''
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._fd = None
+        if self._poller:
+            self._poller.cancel()
+            self._poller = None
+        if self.bus:
+            try:
+                self.bus.close()
+            except:
+                pass
+            self.bus = None
+        if self.connected:
+            self.connected = False
+            self._lines.put_nowait(None)
+
+
+    def SendRequest(self, reqtype):
+        ''' Send a request message '''
+        if self.bus != None:
+            self.bus.write((reqtype + '\n\r').encode())
+
+
+    async def readline(self):
+        ''' Wait for the next line; None when the port is closed or lost '''
+        line = await self._lines.get()
+        if line is None:
+            self._lines.put_nowait(None)        # keep ending for other readers
+        return line
+
+
+    def __aiter__(self):
+        ''' iterate over the received lines '''
+        return self
+
+
+    async def __anext__(self):
+        ''' next received line '''
+        line = await self.readline()
+        if line is None:
+            raise StopAsyncIteration
+        return line
+
+
+    async def _poll(self):
+        ''' Reading for ports without a file descriptor '''
+        while self.connected:
+            self._getdata()
+            await asyncio.sleep(AsyncMeasure.TIMEDELAY)
+
+
+    def _getdata(self):
+        ''' Take everything waiting on the port and queue the complete lines '''
+        try:
+            waiting = self.bus.in_waiting
+            data = self.bus.read(waiting if waiting > 0 else 1)
+        except:     # disconnection
+            self.close()
+            return
+        if len(data) == 0:
+            return
+        self._rxbuffer += data
+        for line in frameLines(self._rxbuffer):
+            line = line.strip()
+            if line:
+                self._lines.put_nowait(line)
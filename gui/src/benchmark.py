@@ -0,0 +1,475 @@
+'''
+Benchmarks for the stimulator host software
+--------------------------------------------
+
+Runs without a stimulator attached; the device side is simulated.
+Normal function:
+  - reader: feed measurement lines at the full line rate of the device
+            (38400 baud) into a loopback port and check that Measure
+            keeps up with it
+  - wakeups: CPU time used by an idle reader, polling versus event waiting
+            on a pseudo terminal (Linux only), and the time a stop takes
+  - writer: commands from several threads through the write queue; shows
+            how many commands are combined in one write
+  - async:  per-device overhead of AsyncMeasure for 1 to 64 simulated ports
+            (pseudo terminals, Linux only) in one event loop
+  - parser: received lines per second through protocol.parse and through
+            the former find()/eval() chain of the GUI
+  - decode: measurement lines per second decoded field by field with int()
+            and as a whole buffer with protocol.decodeMeasurements
+  - emulator: Measure against the firmware emulator (Linux) at 20x speed
+            with damaged output and one disconnect: received pulses and
+            the time until the state was restored
+  - flash:  the flasher (bootld) against the Optiboot emulator (Linux):
+            time of start_cl for the released firmware, a sparse image and
+            a differential flash of one changed page, flash image checked
+  - fleet:  the released firmware into 8 emulated bootloaders at once
+            (flashFleet), against one board after the other
+  - hexfile: reading and slicing a full 32 KB image; a damaged record is
+            refused, a sparse image above 64 KB with EEPROM data keeps only
+            its data
+
+'''
+
+import os
+import sys
+import time
+import asyncio
+import optparse
+import threading
+
+from measuring import Measure, SETTINGCOMMANDS
+from asyncmeasuring import AsyncMeasure
+from emulator import FirmwareEmulator
+from bootemulator import BootloaderEmulator
+from bootld import Bootload, flashFleet, fleetTable
+from loadhex import HexFile
+import numpy as np
+
+from protocol import parse, MeasurementEvent, decodeMeasurements
+
+BAUDRATE = 38400
+CHARTIME = 10.0 / BAUDRATE     # 8N1: 10 bits for every character
+HEXFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', '..', 'firmware', 'src', 'Release', 'MilliPillar3.hex')
+MEASLINE = ': 7F 80 80 7F 80 80 7F 80 80 7F 80 80\r\r\n'    # as sent by vDoWaveform (vSendHex, vSendCR)
+RESPONSELINES = ('\nStimulator Version 3.00.00\r\n', '\nSerial: 12\r\n', '\n!: 00 01\r\n',
+                 '\nVoltage V1, V2:        25, 25\r\n',
+                 '\nTimings T0,T1,T2,T3,T4:1000, 50, 50, 50, 1000\r\n')
+
+
+class LineCounter(object):
+    ''' Display function replacement; counts the received lines '''
+    def __init__(self):
+        ''' constructor '''
+        self.count = 0
+        self.last = 0.0
+
+    def __call__(self, text, Recv=None, Event=None):
+        ''' called from the Measure thread for every complete line '''
+        self.count += 1
+        self.last = time.perf_counter()
+        return True
+
+
+def bench_reader(seconds):
+    ''' Feed lines at the device line rate and report how far the reader lags '''
+    linetime = len(MEASLINE) * CHARTIME
+    total = int(seconds / linetime)
+    counter = LineCounter()
+    meas = Measure(port='loop://', baudrate=BAUDRATE)
+    meas.setDsp(counter)
+    data = MEASLINE.encode()
+    begin = time.perf_counter()
+    for sent in range(total):
+        meas.bus.write(data)        # loopback: the reader receives what is written
+        pause = begin + (sent + 1) * linetime - time.perf_counter()
+        if pause > 0:
+            time.sleep(pause)
+    sendready = time.perf_counter()
+    while counter.count < total and time.perf_counter() - sendready < 2.0:
+        time.sleep(0.001)
+    meas.stop()
+    lag = max(0.0, counter.last - sendready)
+    rate = counter.count / (counter.last - begin) if counter.last > begin else 0.0
+    print('reader: %d/%d lines, device rate %.1f lines/s, received %.1f lines/s, lag %.1f ms'
+          % (counter.count, total, 1.0 / linetime, rate, lag * 1000))
+    return counter.count == total and lag < 10 * linetime
+
+
+def bench_wakeups(seconds):
+    ''' Compare an idle polling reader with an event waiting reader '''
+    master, slave = os.openpty()
+    for eventwait in (False, True):
+        meas = Measure(port=os.ttyname(slave), baudrate=BAUDRATE, eventwait=eventwait)
+        meas.setDsp(LineCounter())
+        cpustart = time.process_time()
+        time.sleep(seconds)
+        cputime = time.process_time() - cpustart
+        os.write(master, MEASLINE.encode())     # one arrival, to be sure it is still awake
+        time.sleep(0.1)
+        stopstart = time.perf_counter()
+        meas.stop()
+        meas.join(1.0)
+        stoptime = time.perf_counter() - stopstart
+        print('wakeups: %-5s idle CPU %.1f%%, stop took %.1f ms'
+              % ('event' if eventwait else 'poll', 100.0 * cputime / seconds, stoptime * 1000))
+    os.close(master)
+    os.close(slave)
+    return True
+
+
+def bench_writer(seconds):
+    ''' Scripted command sequences (as _storeSettings) from 4 threads at once '''
+    meas = Measure(port='loop://', baudrate=BAUDRATE)
+    meas.setDsp(LineCounter())
+    sequence = ('sv 25,25', 'st 1000,50,50,50,1000', 'wr')
+    count = max(1, int(seconds * 100))
+
+    def script():
+        for _ in range(count):
+            for command in sequence:
+                meas.SendRequest(command)
+
+    begin = time.perf_counter()
+    threads = [threading.Thread(target=script) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # sv and st are read back with 'ss' (Measure.SendRequest)
+    expected = 4 * count * sum(1 + (command[:2] in SETTINGCOMMANDS) for command in sequence)
+    while meas.writeStatistics()['commands'] < expected and time.perf_counter() - begin < 10.0:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - begin
+    meas.stop()
+    meas.join(1.0)
+    stats = meas.writeStatistics()
+    print('writer: %d commands in %d writes (%.1f commands, %.1f bytes per write), '
+          'max queue depth %d, %.1f ms'
+          % (stats['commands'], stats['writes'], stats['commands'] / max(1, stats['writes']),
+             stats['bytesperwrite'], stats['maxqueuedepth'], elapsed * 1000))
+    return stats['commands'] == expected
+
+
+async def _asyncdevices(count, seconds):
+    ''' Run count simulated devices at line rate; returns (lines received, CPU seconds) '''
+    ptys = [os.openpty() for _ in range(count)]
+    devices = [AsyncMeasure(os.ttyname(slave), BAUDRATE) for _master, slave in ptys]
+    for meas in devices:
+        await meas.open()
+    received = [0]
+
+    async def consume(meas):
+        async for _line in meas:
+            received[0] += 1
+
+    consumers = [asyncio.create_task(consume(meas)) for meas in devices]
+    linetime = len(MEASLINE) * CHARTIME
+    data = MEASLINE.encode()
+    total = int(seconds / linetime)
+    cpustart = time.process_time()
+    begin = time.perf_counter()
+    for sent in range(total):
+        for master, _slave in ptys:
+            os.write(master, data)
+        await asyncio.sleep(max(0.0, begin + (sent + 1) * linetime - time.perf_counter()))
+    await asyncio.sleep(0.1)
+    cputime = time.process_time() - cpustart
+    for meas in devices:
+        meas.close()
+    await asyncio.gather(*consumers)
+    for master, slave in ptys:
+        os.close(master)
+        os.close(slave)
+    return received[0], total * count, cputime
+
+
+def bench_async(seconds):
+    ''' Scaling of AsyncMeasure from 1 to 64 ports at the device line rate '''
+    result = True
+    count = 1
+    while count <= 64:
+        received, sent, cputime = asyncio.run(_asyncdevices(count, seconds))
+        print('async: %2d ports, %6d/%6d lines, CPU %5.1f%%, %.2f ms CPU per device-second'
+              % (count, received, sent, 100.0 * cputime / seconds, 1000.0 * cputime / seconds / count))
+        result = result and received == sent
+        count *= 2
+    return result
+
+
+def _findchain(Recv):
+    ''' The former line handling of the GUI (UpdateScrStatus), without the screen '''
+    Recv = Recv.strip()
+    if Recv.find('TERM> ') == 0 :
+        Recv = Recv[6:]
+    if Recv.find('Stimulator Version') == 0 :
+        return Recv[19:]
+    elif Recv.find('Serial:') >= 0:
+        return Recv[7:]
+    elif Recv.find('!:') == 0:
+        return (Recv[3:5] != '00', Recv[6:8] != '00')
+    elif Recv.find('Voltage V1, V2:') == 0:
+        Recv = Recv[16:].strip()
+        Comma = Recv.find(',')
+        return (eval(Recv[:Comma])/10, eval(Recv[(Comma+2):])/10)
+    elif Recv.find('Timings T0,T1,T2,T3,T4:') == 0:
+        Recv = Recv[23:].strip()
+        times = []
+        for _ in range(4):
+            Comma = Recv.find(',')
+            times.append(int(Recv[:Comma]))
+            Recv = Recv[Comma+1:]
+        return times + [int(Recv)]
+    elif Recv.find(': ') == 0:
+        return [int(Recv[i:i+2], 16) for i in (2, 5, 8, 17, 20, 23, 26, 35)]
+    return None
+
+
+def bench_parser(seconds):
+    ''' Lines per second of both parsers; one response line per 100 measurement lines '''
+    lines = ([MEASLINE] * 100 + list(RESPONSELINES)) * 20
+    for name, function in (('find chain', _findchain), ('protocol', parse)):
+        count = 0
+        begin = time.perf_counter()
+        while time.perf_counter() - begin < seconds / 2:
+            for line in lines:
+                function(line)
+            count += len(lines)
+        rate = count / (time.perf_counter() - begin)
+        print('parser: %-10s %9.0f lines/s' % (name, rate))
+    events = [parse(line) for line in lines]
+    result = sum(isinstance(event, MeasurementEvent) for event in events) == 2000
+    return result and all(event.field for event in events)
+
+
+def _intfields(data):
+    ''' Decoding as before: every line a string, every field an int() '''
+    result = []
+    for line in data.decode('ascii').split('\r'):
+        line = line.strip()
+        if line.startswith(': '):
+            result.append([int(line[i:i+2], 16) for i in range(2, 37, 3)])
+    return result
+
+
+def bench_decode(seconds):
+    ''' Pulses per second: int() per field against the batch decoder (100000 lines) '''
+    data = (MEASLINE * 100000).encode()
+    results = []
+    for name, function in (('int fields', _intfields), ('batch', decodeMeasurements)):
+        count = 0
+        begin = time.perf_counter()
+        while time.perf_counter() - begin < seconds / 2:
+            values = function(data)
+            count += len(values)
+        results.append(np.asarray(values, dtype=np.uint8))
+        print('decode: %-10s %11.0f pulses/s' % (name, count / (time.perf_counter() - begin)))
+    return results[0].shape == (100000, 12) and (results[0] == results[1]).all()
+
+
+def bench_emulator(seconds):
+    ''' Throughput and recovery against the emulator: fast pulses, faults, one disconnect '''
+    link = '/tmp/stimulator-benchmark-%d' % os.getpid()
+    emulator = FirmwareEmulator(link, speedup=20, droprate=0.0005, garbagerate=0.0005, seed=1)
+    emulator.start()
+    meas = Measure(port=link, baudrate=BAUDRATE)
+    meas.setDsp(LineCounter())
+    result = meas.waitReady() is not None
+    for command in ('st 0,10,10,10,5', 'ss', 'ru'):
+        meas.SendRequest(command)
+    time.sleep(seconds / 2)
+    emulator.disconnect(0.5)
+    time.sleep(seconds / 2 + 1.0)
+    meas.stop()
+    meas.join(1.0)
+    emulator.stop()
+    emulator.join(2.0)
+    stats = emulator.statistics()
+    print('emulator: %d of %d pulses received (%.0f/s), %d dropped and %d garbage bytes, '
+          'outages %s'
+          % (meas.pulses.total, stats['pulses'], meas.pulses.total / (seconds + 1.5),
+             stats['dropped'], stats['garbage'],
+             ', '.join('%.2f s' % duration for _begin, duration in meas.outages) or 'none'))
+    return result and len(meas.outages) == 1 and meas.pulses.total > 0.9 * stats['pulses']
+
+
+def _writeHex(filename, blocks):
+    ''' An Intel hex file of (address, data) blocks (16 bytes per record; an
+        extended linear address record for every other 64 KB)
+    '''
+    upper = 0
+    with open(filename, 'w', encoding='utf-8') as outfile:
+        for address, data in blocks:
+            for offset in range(0, len(data), 16):
+                if (address + offset) >> 16 != upper:
+                    upper = (address + offset) >> 16
+                    record = bytes([2, 0, 0, 4, upper >> 8, upper & 0xFF])
+                    outfile.write(':%s%02X\n' % (record.hex().upper(), -sum(record) & 0xFF))
+                record = bytes([len(data[offset:offset + 16]), (address + offset) >> 8 & 0xFF,
+                                (address + offset) & 0xFF, 0]) + data[offset:offset + 16]
+                outfile.write(':%s%02X\n' % (record.hex().upper(), -sum(record) & 0xFF))
+        outfile.write(':00000001FF\n')
+
+
+def _flash(hexfile, emulator = None, differential = False):
+    ''' Flash hexfile into an emulated bootloader (a new one by default);
+        returns (success, seconds, pages written)
+    '''
+    own = emulator is None
+    if own:
+        emulator = BootloaderEmulator()
+        emulator.start()
+    writes = emulator.statistics()['pagewrites']
+    flasher = Bootload(hexfile, emulator.port, differential)
+    emulator.reset()                    # no DTR on a pseudo terminal
+    begin = time.perf_counter()
+    result = flasher.start_cl() == 0
+    elapsed = time.perf_counter() - begin
+    if own:
+        emulator.stop()
+        emulator.join(2.0)
+    image = HexFile(hexfile)
+    image.readfile()
+    result = result and all(emulator.flash[first:last] == image.getmemoryportion(first, last - first)
+                            for first, last in image.ranges)
+    return result, elapsed, emulator.statistics()['pagewrites'] - writes
+
+
+def bench_flash(_seconds):
+    ''' Flashes through start_cl: the released firmware, a sparse image, and
+        the firmware with one changed byte (differential, on the flashed device)
+    '''
+    sparse = '/tmp/stimulator-sparse-%d.hex' % os.getpid()
+    changed = '/tmp/stimulator-changed-%d.hex' % os.getpid()
+    _writeHex(sparse, [(0x0000, bytes(range(64))), (0x2000, b'\xff' * 256),
+                       (0x4000, bytes(range(16)))])
+    image = HexFile(HEXFILE)
+    image.readfile()
+    memory = bytearray(image.getmemoryportion(0, image.endaddress))
+    memory[len(memory) // 2] ^= 0xFF
+    _writeHex(changed, [(0, bytes(memory))])
+    emulator = BootloaderEmulator()
+    emulator.start()
+    result = True
+    for name, hexfile, device, differential in (('firmware', HEXFILE, emulator, False),
+                                                ('sparse', sparse, None, False),
+                                                ('changed', changed, emulator, True)):
+        success, elapsed, pages = _flash(hexfile, device, differential)
+        print('flash: %-8s %.2f s, %d pages written%s'
+              % (name, elapsed, pages, ' (differential)' if differential else ''))
+        result = result and success
+    emulator.stop()
+    emulator.join(2.0)
+    os.remove(sparse)
+    os.remove(changed)
+    return result
+
+
+def bench_hexfile(seconds):
+    ''' Reading a full 32 KB image and slicing it into pages; a damaged
+        record must be refused, and a sparse image above 64 KB with EEPROM
+        data must keep only its data
+    '''
+    full = '/tmp/stimulator-full-%d.hex' % os.getpid()
+    damaged = '/tmp/stimulator-damaged-%d.hex' % os.getpid()
+    sparse = '/tmp/stimulator-sparse-%d.hex' % os.getpid()
+    _writeHex(full, [(0, bytes(i * 7 & 0xFF for i in range(0x8000)))])
+    _writeHex(sparse, [(0, bytes(range(200))), (0x3E000, bytes(range(64))),
+                       (0x810000, b'EEPROM')])
+    with open(full, encoding='utf-8') as infile:
+        lines = infile.readlines()
+    lines[100] = lines[100][:12] + ('0' if lines[100][12] != '0' else '1') + lines[100][13:]
+    with open(damaged, 'w', encoding='utf-8') as outfile:
+        outfile.writelines(lines)
+    reads = 0
+    begin = time.perf_counter()
+    while time.perf_counter() - begin < seconds / 2:
+        image = HexFile(full)
+        image.readfile()
+        reads += 1
+    readtime = (time.perf_counter() - begin) / reads
+    slices = 0
+    begin = time.perf_counter()
+    while time.perf_counter() - begin < seconds / 2:
+        pages = image.pages(128)
+        for page in pages:
+            image.getmemoryportion(page * 128, 128)
+        slices += len(pages)
+    slicetime = (time.perf_counter() - begin) / slices
+    try:
+        HexFile(damaged).readfile()
+        refused = False
+    except ValueError as error:
+        refused = True
+        print('hexfile: damaged file refused: %s' % error)
+    big = HexFile(sparse)
+    big.readfile()
+    stored = sum(len(memory) for _address, memory in big.segments)
+    os.remove(full)
+    os.remove(damaged)
+    os.remove(sparse)
+    print('hexfile: 32 KB image read in %.2f ms, %.2f us per page (pages and slice)'
+          % (readtime * 1e3, slicetime * 1e6))
+    print('hexfile: sparse image up to 0x%X: %d segments, %d bytes stored, flash pages %s, EEPROM %r'
+          % (big.ranges[-1][1], len(big.segments), stored, big.pages(128), bytes(big.eeprom())))
+    return refused and len(pages) == 0x8000 // 128 and \
+           bytes(image.getmemoryportion(0x100, 4)) == bytes(i * 7 & 0xFF for i in range(0x100, 0x104)) and \
+           big.pages(128) == [0, 1, 0x3E000 // 128] and bytes(big.eeprom()) == b'EEPROM' and \
+           stored == 200 + 64 + 6
+
+
+def bench_fleet(_seconds, boards = 8):
+    ''' The released firmware into a fleet of emulated bootloaders at once
+        (flashFleet), against one board after the other
+    '''
+    single, one, _pages = _flash(HEXFILE)
+    emulators = [BootloaderEmulator(waittime = 5.0) for _board in range(boards)]
+    for emulator in emulators:
+        emulator.start()
+        emulator.reset()                # no DTR on a pseudo terminal
+    begin = time.perf_counter()
+    results = flashFleet(HEXFILE, [emulator.port for emulator in emulators])
+    elapsed = time.perf_counter() - begin
+    image = HexFile(HEXFILE)
+    image.readfile()
+    for emulator in emulators:
+        emulator.stop()
+        emulator.join(2.0)
+    print('\n'.join(fleetTable(results)))
+    print('fleet: %d boards in %.2f s, one after the other %.2f s (%.1fx)'
+          % (boards, elapsed, boards * one, boards * one / elapsed))
+    return single and all(result['success'] for result in results) and \
+           all(emulator.flash[first:last] == image.getmemoryportion(first, last - first)
+               for emulator in emulators for first, last in image.ranges)
+
+
+def main():
+    ''' Starts the benchmarks '''
+    parser = optparse.OptionParser(
+        usage = "%prog [options]",
+        description = "Benchmarks for the stimulator host software (no hardware needed)" )
+
+    parser.add_option("-t", "--test", dest = "test",
+                      help = "Benchmark to run: reader, wakeups, writer, async, parser, decode, emulator, flash, fleet, hexfile",
+                      default = "reader")
+    parser.add_option("-s", "--seconds", dest = "seconds", type = "float",
+                      help = "Duration of the benchmark in seconds",
+                      default = 5.0)
+
+    (options, _args) = parser.parse_args()
+
+    tests = {'reader': bench_reader, 'wakeups': bench_wakeups, 'writer': bench_writer,
+             'async': bench_async, 'parser': bench_parser, 'decode': bench_decode,
+             'emulator': bench_emulator, 'flash': bench_flash,
+             'fleet': bench_fleet, 'hexfile': bench_hexfile}
+    if options.test not in tests:
+        parser.print_help()
+        sys.exit(1)
+    if not tests[options.test](options.seconds):
+        print('%s: FAILED' % options.test)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
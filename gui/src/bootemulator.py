@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+'''
+Emulator of the Optiboot bootloader
+-----------------------------------
+
+The STK500 subset of Optiboot (ATmega328P) behind a pseudo terminal (Linux),
+for testing and timing the flasher (bootld) without a board:
+
+    GET_SYNC, GET_PARAMETER, SET_DEVICE(_EXT), ENTER/LEAVE_PROGMODE,
+    LOAD_ADDRESS, UNIVERSAL, PROG_PAGE, READ_PAGE, READ_SIGN
+
+The flash is an in-memory image (`flash`), to be checked after flashing.
+Programming a page takes `pagetime` s (erase and write); the serial line
+runs at `baudrate`, so the time of a flash is close to a real board.
+
+A pseudo terminal has no DTR/RTS: reset() takes the place of the reset
+through DTR. After a reset the bootloader waits `waittime` s for the first
+command; after LEAVE_PROGMODE, that time or a command without CRC_EOP it
+starts the application (and ignores the port until the next reset).
+
+    emulator = BootloaderEmulator(link='/tmp/optiboot')
+    emulator.start()
+    Bootload('firmware.hex', emulator.port).start_cl()
+    image = emulator.flash
+'''
+import sys
+import time
+import select
+import optparse
+import threading
+
+from emulator import PseudoTerminal
+
+FLASHSIZE = 0x8000
+PAGESIZE = 128
+PAGETIME = 0.0045               # s; page erase and write of the ATmega328P
+BAUDRATE = 115200
+WAITTIME = 1.0                  # s; the watchdog time of Optiboot after a reset
+SIGNATURE = b'\x1e\x95\x0f'     # ATmega328P
+
+STK_OK = 0x10
+STK_INSYNC = 0x14
+CRC_EOP = 0x20
+STK_GET_SYNC = 0x30
+STK_GET_SIGN_ON = 0x31
+STK_GET_PARAMETER = 0x41
+STK_SET_DEVICE = 0x42
+STK_SET_DEVICE_EXT = 0x45
+STK_ENTER_PROGMODE = 0x50
+STK_LEAVE_PROGMODE = 0x51
+STK_LOAD_ADDRESS = 0x55
+STK_UNIVERSAL = 0x56
+STK_PROG_PAGE = 0x64
+STK_READ_PAGE = 0x74
+STK_READ_SIGN = 0x75
+
+# command: number of argument bytes before CRC_EOP (PROG_PAGE: 3 + length)
+ARGUMENTS = {STK_GET_SYNC: 0, STK_GET_SIGN_ON: 0, STK_GET_PARAMETER: 1, STK_SET_DEVICE: 20,
+             STK_SET_DEVICE_EXT: 5, STK_ENTER_PROGMODE: 0, STK_LEAVE_PROGMODE: 0,
+             STK_LOAD_ADDRESS: 2, STK_UNIVERSAL: 4, STK_READ_PAGE: 3, STK_READ_SIGN: 0}
+
+
+class Optiboot(object):
+    ''' The bootloader: STK500 commands on a pseudo terminal, with a flash image '''
+
+    def __init__(self, flashsize = FLASHSIZE, pagesize = PAGESIZE, pagetime = PAGETIME,
+                 baudrate = BAUDRATE, image = None):
+        ''' constructor; image: initial flash contents (default erased) '''
+        self.pagesize = pagesize
+        self.pagetime = pagetime
+        self.flash = bytearray(b'\xff' * flashsize)
+        if image:
+            self.flash[:len(image)] = image
+        self.pagewrites = 0             # statistics
+        self.pagereads = 0
+        self.syncs = 0
+        self.errors = 0
+        self._chartime = 10.0 / baudrate
+        self._address = 0               # byte address
+        self._pty = None
+        self._input = bytearray()
+        self._arrival = 0.0             # when the current command started to arrive
+
+
+    def serve(self, pty, waittime = WAITTIME, stopevent = None):
+        ''' Run the bootloader after a reset until it starts the application
+            (LEAVE_PROGMODE, no command within waittime, or a protocol error)
+        '''
+        self._pty = pty
+        self._input.clear()
+        deadline = time.monotonic() + waittime
+        while not (stopevent and stopevent.is_set()):
+            if not self._input:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                select.select([pty.master], [], [], min(remaining, 0.05))
+                self._input += pty.read()
+                self._arrival = time.monotonic()
+                continue
+            result = self._command()
+            if result is None:          # incomplete: wait for the rest
+                select.select([pty.master], [], [], 0.05)
+                self._input += pty.read()
+            elif not result:
+                return
+            else:
+                deadline = time.monotonic() + waittime     # the watchdog is reset
+
+
+    def _command(self):
+        ''' Handle the first command of the input; None: not complete yet,
+            False: the bootloader ends, True: go on
+        '''
+        command = self._input[0]
+        if command == STK_PROG_PAGE:
+            if len(self._input) < 3:
+                return None
+            length = 3 + (self._input[1] << 8 | self._input[2])
+        else:
+            length = ARGUMENTS.get(command, 0)
+        if len(self._input) < length + 2:
+            return None
+        arguments = bytes(self._input[1:length + 1])
+        eop = self._input[length + 1]
+        del self._input[:length + 2]
+        self._line(length + 2)
+        if eop != CRC_EOP:              # verifySpace: watchdog reset into the application
+            self.errors += 1
+            return False
+        reply = self._execute(command, arguments)
+        self._pty.write(bytes([STK_INSYNC]) + reply + bytes([STK_OK]))
+        self._line(len(reply) + 2)
+        self._arrival = time.monotonic()
+        return command != STK_LEAVE_PROGMODE
+
+
+    def _line(self, count):
+        ''' the time count characters take on the serial line '''
+        end = self._arrival + count * self._chartime
+        remaining = end - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        self._arrival = max(end, time.monotonic())
+
+
+    def _execute(self, command, arguments):
+        ''' The command itself; returns the bytes between INSYNC and OK '''
+        if command == STK_GET_SYNC:
+            self.syncs += 1
+        elif command == STK_GET_PARAMETER:
+            return bytes([{0x81: 8, 0x82: 0}.get(arguments[0], 3)])   # Optiboot 8.0
+        elif command == STK_LOAD_ADDRESS:
+            self._address = (arguments[0] | arguments[1] << 8) * 2   # word address
+        elif command == STK_UNIVERSAL:
+            return b'\x00'
+        elif command == STK_PROG_PAGE:
+            self._program(arguments[3:], arguments[2])
+        elif command == STK_READ_PAGE:
+            length = arguments[0] << 8 | arguments[1]
+            self.pagereads += 1
+            return bytes(self.flash[self._address:self._address + length])
+        elif command == STK_READ_SIGN:
+            return SIGNATURE
+        return b''
+
+
+    def _program(self, data, memtype):
+        ''' Erase the page of the address and write the data (EEPROM writes are ignored) '''
+        if memtype == ord('E'):
+            return
+        start = self._address - self._address % self.pagesize
+        if start + self.pagesize > len(self.flash) or len(data) > self.pagesize:
+            self.errors += 1
+            return
+        page = bytearray(b'\xff' * self.pagesize)
+        offset = self._address - start
+        for i, byte in enumerate(data):
+            page[(offset + i) % self.pagesize] = byte
+        time.sleep(self.pagetime)
+        self.flash[start:start + self.pagesize] = page
+        self.pagewrites += 1
+
+
+class BootloaderEmulator(threading.Thread):
+    ''' classdocs BootloaderEmulator
+    A board with only the bootloader: Optiboot after every reset()
+    '''
+
+    def __init__(self, link = None, waittime = WAITTIME, **options):
+        ''' Constructor; the terminal exists at once, start() gives the first reset
+            options: see Optiboot (flashsize, pagesize, pagetime, baudrate, image)
+        '''
+        threading.Thread.__init__(self, name="Stimulator-bootloader", daemon=True)
+        self.waittime = waittime
+        self.bootloader = Optiboot(**options)
+        self.resets = 0
+        self._reset = threading.Event()
+        self._reset.set()
+        self._stopevent = threading.Event()
+        self._pty = PseudoTerminal(link)
+        self._pty.open()
+
+
+    @property
+    def port(self):
+        ''' the port name for the host '''
+        return self._pty.port
+
+
+    @property
+    def flash(self):
+        ''' the flash image '''
+        return self.bootloader.flash
+
+
+    def reset(self):
+        ''' The reset through DTR: the bootloader starts again '''
+        self._reset.set()
+
+
+    def stop(self):
+        ''' End the emulation and remove the terminal '''
+        self._stopevent.set()
+        self._reset.set()
+
+
+    def statistics(self):
+        ''' counters of the emulation '''
+        return {'resets': self.resets, 'syncs': self.bootloader.syncs,
+                'pagewrites': self.bootloader.pagewrites, 'pagereads': self.bootloader.pagereads,
+                'errors': self.bootloader.errors}
+
+
+    def run(self):
+        ''' Bootloader after every reset; the application in between ignores the port '''
+        while not self._stopevent.is_set():
+            self._reset.wait()
+            self._reset.clear()
+            if self._stopevent.is_set():
+                break
+            self.resets += 1
+            self._pty.read()        # what came before the reset is lost
+            self.bootloader.serve(self._pty, self.waittime, self._stopevent)
+        self._pty.close()
+
+
+def main():
+    ''' Run an emulated bootloader until Ctrl-C; every Enter gives a reset '''
+    parser = optparse.OptionParser(
+        usage = "%prog [options]",
+        description = "Emulated Optiboot bootloader on a pseudo terminal (Linux)" )
+
+    parser.add_option("-l", "--link", dest = "link",
+                      help = "Name for the port (a link to the pseudo terminal)",
+                      default = None)
+    parser.add_option("-t", "--pagetime", dest = "pagetime", type = "float",
+                      help = "Time to program a page (s)",
+                      default = PAGETIME)
+    parser.add_option("-s", "--pagesize", dest = "pagesize", type = "int",
+                      help = "Size of a flash page (bytes)",
+                      default = PAGESIZE)
+
+    (options, _args) = parser.parse_args()
+
+    emulator = BootloaderEmulator(options.link, pagetime=options.pagetime,
+                                  pagesize=options.pagesize)
+    emulator.start()
+    print('Emulated bootloader on %s; Enter: reset, Ctrl-C: stop' % emulator.port)
+    try:
+        for _line in sys.stdin:
+            emulator.reset()
+            print(emulator.statistics())
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    emulator.join(2.0)
+    print(emulator.statistics())
+
+
+if __name__ == '__main__':
+    main()
@@ -6,27 +6,62 @@ Contains the main configuration startup and starts all elements
 Normal function:
   - Read the hex file
   - Reset connected arduino
-  - ping every 0.03 s for reaction
-  - if within 5 sec reaction:
-    - Repeat:
+  - ping until the bootloader reacts (within SYNCWAIT)
+  - if reaction:
+    - For every page with data (see HexFile.pages):
        - Transfer datablock 128 bytes, and 
        - Flash
-    - Until ready
+       (cancelevent set: stop before the next page; the device needs a new flash)
     - Send reset 
-    
+
+    Differential (-d): the pages are compared with the flash of the device
+    first (STK_READ_PAGE, or the page hashes of the last flash of the same
+    serial number, see MANIFESTDIR); only the changed pages are flashed and
+    read back for verification.
+    The manifest is kept up to date by every flash with a serial number (-n),
+    differential or not; pages are removed from it before they are programmed,
+    so a cancelled or failed flash reads them back the next time.
+    A flash with any other tool (avrdude, the Arduino IDE) or without the
+    serial number invalidates the manifest: remove the file, or it claims
+    pages that are no longer on the device.
+
+    Every step waits for the answer of the device (INSYNC, OK) and goes on
+    as soon as it is there; a deadline per step (the line time of the data
+    plus the flash time) detects a missing answer.
     Note: timing is delicate
+
+    Fleet (-p port1,port2,.. or -p usb: all USB ports): the hex file is read
+    once and all boards are flashed at the same time, a worker thread per
+    port; a board that fails is flashed once more. A table gives per port
+    the result, the duration and the retries (see flashFleet).
 '''
 
+import os
 import sys
+import json
 import time
+import hashlib
 import optparse
 import traceback
 import serial
+import serial.tools.list_ports
+from concurrent.futures import ThreadPoolExecutor
 
 from loadhex import HexFile
 
 
 BLOCKSIZE = 128     # size for the ATmega328
+MAXFLASH = 0x20000  # bytes; LOAD_ADDRESS takes a 16 bit word address (EEPROM data is not flashed)
+BAUDRATE = 115200
+READTIME = 0.005    # s; a read returns at the first character, or after this time
+RESPONSETIME = 0.05 # s; deadline for the answer on a command
+PAGEWRITETIME = 0.0045  # s; erase and write time of a page
+PROGRAMTIME = 0.05  # s; deadline for the erase and write of a page
+RESETTIME = 0.4     # s; after the reset, until the bootloader listens (LED flashes)
+SYNCTIME = 0.05     # s; deadline for the answer on a GET_SYNC
+SYNCWAIT = 0.5      # s; the bootloader is pinged during this time
+FLEETATTEMPTS = 2   # flashes of a board in a fleet, before it counts as failed
+MANIFESTDIR = os.path.join(os.path.expanduser('~'), 'MilliPillar3', 'flash')  # page hashes per serial
 
 # STK500 Commands
 
@@ -39,83 +74,120 @@ STK_ENTER_PROGMODE  = 0x50  #// 'P'
 STK_LEAVE_PROGMODE  = 0x51  #// 'Q'
 STK_LOAD_ADDRESS    = 0x55  #// 'U'
 STK_PROG_PAGE       = 0x64  #// 'd'
+STK_READ_PAGE       = 0x74  #// 't'
 
 
 class Bootload(object):
     ''' Contains the  application '''
-    def __init__(self, hexfile, comport):
-        ''' Application (root) object constructor '''
+    def __init__(self, hexfile, comport, differential = False, serialnumber = None,
+                 datafile = None, cancelevent = None):
+        ''' Application (root) object constructor
+            differential: flash only the pages that differ from the device
+            serialnumber: of the device, for its manifest of page hashes (None: read the pages)
+            datafile: the HexFile of hexfile, already read (shared by a fleet, see flashFleet)
+            cancelevent: threading.Event; when set, the flash stops before the next page
+        '''
         self.pagesize = 0
         self.flashsize = 0
-        self.datafile = HexFile(hexfile)
+        self._loaded = datafile is not None
+        self.datafile = datafile if self._loaded else HexFile(hexfile)
         self.hexfile = hexfile
         self.dspfunction = None
+        self.differential = differential
+        self.cancelevent = cancelevent
+        self.serialnumber = serialnumber
+        self.flashtime = 0.0            # s, of the last flash (without reset and sync)
+        self.bytespersecond = 0.0
+        self.skipped = 0                # pages equal on the device (differential)
+        self.saved = 0.0                # s, estimated gain of the skipped pages
+        self.retries = 0                # pages sent again in the last flash
         self.serial = None
         retry = 0
         while retry < 2 and self.serial == None:
             try:
                 self.serial = serial.Serial( comport,
-                                             115200,
+                                             BAUDRATE,
                                              parity='N',
-                                             rtscts=False, xonxoff=False, timeout=0 )
+                                             rtscts=False, xonxoff=False, timeout=READTIME )
             except:
                 time.sleep(1)
                 retry += 1
+        if self.serial == None:
+            raise serial.SerialException('Port %s not present' % comport)
         if self.serial.isOpen():
             self.serial.close()
         try:
             self.serial.open()
         except:
             print(traceback.format_exc())
-        self.serial.dtr = False
-        self.serial.rts = False
+        self._setResetLines(False)
 
 
     def stop(self):
         ''' Stopping this thread '''
-        self.serial.dtr = False
-        self.serial.rts = False
+        self._setResetLines(False)
         self.serial.close()
 
 
-    def sendCommand(self, cmd, data):
-        ''' Send a specific command to the device '''
-        fullcommand = [cmd]
+    def _setResetLines(self, state):
+        ''' DTR and RTS (True: reset the device)
+            Ports without modem lines (pseudo terminals) have to be reset otherwise
+        '''
+        try:
+            self.serial.dtr = state
+            self.serial.rts = state
+        except (OSError, serial.SerialException):
+            pass
+
+
+    def sendCommand(self, cmd, data, payload = None):
+        ''' Send a specific command to the device, in one write
+            data: the argument bytes; payload: bytes-like (a page of the hex file)
+        '''
+        fullcommand = bytearray([cmd])
         if data:
-            fullcommand += data
-        fullcommand += [CRC_EOP]
+            fullcommand.extend(data)
+        if payload:
+            fullcommand += payload
+        fullcommand.append(CRC_EOP)
         if self.serial != None:
             self.serial.write(fullcommand)
             
 
-    def waitforChar(self, char):
-        ''' wait for the INSYNC / STK_OK'''
-        count = 0
-        while count < 5:
+    def waitforChar(self, char, timeout = RESPONSETIME):
+        ''' wait for the INSYNC / STK_OK
+            The character is taken as soon as it arrives (other characters are
+            skipped); False when it did not come within timeout s
+        '''
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
             recv = self.serial.read(1)
-            #if recv != '':
-            #    print('recv %r' % recv)
             if recv == char:
                 return True
-            time.sleep(0.01)
-            count += 1
         return False
-    
+
+
+    def _response(self, timeout = RESPONSETIME):
+        ''' wait for the INSYNC and STK_OK of a command, within timeout s '''
+        deadline = time.monotonic() + timeout
+        return self.waitforChar(STK_INSYNC, timeout) and \
+               self.waitforChar(STK_OK, max(0.0, deadline - time.monotonic()))
+
 
     def _pingpresence(self):
         ''' Check for presence of the Device in programming mode
             If it reacts on the message: the Device is in boot programming mode
         '''
-        counter = 0
-        while counter < 5: # maximal 0.5 seconds pinging
+        deadline = time.monotonic() + SYNCWAIT
+        pings = 0
+        while time.monotonic() < deadline:
             self.sendCommand(STK_GET_SYNC, None)
-            time.sleep(0.01)               # wait for sending it
-            if self.waitforChar(STK_INSYNC):
-                time.sleep(0.05)
-                if self.waitforChar(STK_OK):
-                    return True
-            time.sleep(0.005)  # wait 10 ms
-            counter += 1
+            pings += 1
+            if self._response(SYNCTIME):
+                if pings > 1:           # late answers of the earlier pings
+                    time.sleep(SYNCTIME)
+                    self.serial.reset_input_buffer()
+                return True
         return False  # nothing found
 
 
@@ -125,38 +197,137 @@ class Bootload(object):
         flashwordaddress = (flashstartaddress >> 1)
         internalbuf = self.datafile.getmemoryportion(flashstartaddress, BLOCKSIZE)
         flashlength = len(internalbuf)
+        # sending the page at the line speed and programming it
+        pagetime = RESPONSETIME + PROGRAMTIME + (flashlength + 5) * 10.0 / BAUDRATE
         counter = 0
         while counter < 3:
+            if counter:
+                self.retries += 1
             counter += 1
             addr = [flashwordaddress & 0xFF, (flashwordaddress >> 8) & 0xFF]
             self.sendCommand(STK_LOAD_ADDRESS, addr)
-            time.sleep(0.01)    # 4 bytes at high speed to send
-            if self.waitforChar(STK_INSYNC):
-                time.sleep(0.01)
-                if self.waitforChar(STK_OK):
-                    data = [0, flashlength, 1] + internalbuf
-                    self.sendCommand(STK_PROG_PAGE, data)
-                    time.sleep(flashlength/1000)    # wait for emitting the data
-                    if self.waitforChar(STK_INSYNC):
-                        time.sleep(0.1) # flash it
-                        if self.waitforChar(STK_OK):
-                            return True
-                    print('Error sending block %d' % blk)
-            time.sleep(0.1)
+            if self._response():
+                self.sendCommand(STK_PROG_PAGE, [0, flashlength, 1], internalbuf)
+                if self._response(pagetime):
+                    return True
+                print('Error sending block %d' % blk)
+            self.serial.reset_input_buffer()    # no late answers in the next try
         return False
 
 
+    def _readpage(self, blk, length):
+        ''' The contents of a flash page on the device (None on an error) '''
+        flashwordaddress = (blk * BLOCKSIZE) >> 1
+        self.sendCommand(STK_LOAD_ADDRESS, [flashwordaddress & 0xFF, (flashwordaddress >> 8) & 0xFF])
+        if not self._response():
+            return None
+        self.sendCommand(STK_READ_PAGE, [0, length, ord('F')])
+        deadline = time.monotonic() + RESPONSETIME + (length + 2) * 10.0 / BAUDRATE
+        if not self.waitforChar(STK_INSYNC, max(0.0, deadline - time.monotonic())):
+            return None
+        data = bytearray()
+        while len(data) < length and time.monotonic() < deadline:
+            data += self.serial.read(length - len(data))
+        if len(data) < length or not self.waitforChar(STK_OK, max(0.0, deadline - time.monotonic())):
+            return None
+        return bytes(data)
+
+
+    def _pagedata(self, blk):
+        ''' the contents of a page of the hex file '''
+        return bytes(self.datafile.getmemoryportion(blk * BLOCKSIZE, BLOCKSIZE))
+
+
+    def _pagehash(self, blk):
+        ''' hash of the contents of a page of the hex file '''
+        return hashlib.sha1(self._pagedata(blk)).hexdigest()
+
+
+    def _manifestname(self):
+        ''' file with the page hashes of the device (None without serial number) '''
+        if self.serialnumber is None:
+            return None
+        return os.path.join(MANIFESTDIR, 'stimulator_%s.json' % self.serialnumber)
+
+
+    def _readmanifest(self):
+        ''' page number: hash, as flashed the last time (by this program!) '''
+        if self._manifestname() is None:
+            return {}
+        try:
+            with open(self._manifestname(), 'r', encoding='utf-8') as infile:
+                manifest = json.load(infile)
+            if manifest.get('pagesize') == BLOCKSIZE:
+                return {int(page): value for page, value in manifest['pages'].items()}
+        except:     # no (valid) manifest: read the pages
+            pass
+        return {}
+
+
+    def _writemanifest(self, pages):
+        ''' remember the hashes of the pages on the device '''
+        manifest = self._readmanifest()
+        manifest.update({page: self._pagehash(page) for page in pages})
+        self._storemanifest(manifest)
+
+
+    def _forgetmanifest(self, pages):
+        ''' the pages will be programmed: their hashes are no longer known '''
+        manifest = self._readmanifest()
+        if any(page in manifest for page in pages):
+            self._storemanifest({page: value for page, value in manifest.items()
+                                 if page not in pages})
+
+
+    def _storemanifest(self, manifest):
+        ''' write the page hashes (no serial number: nothing to store) '''
+        name = self._manifestname()
+        if name is None:
+            return
+        try:
+            os.makedirs(MANIFESTDIR, exist_ok=True)
+            with open(name, 'w', encoding='utf-8') as outfile:
+                json.dump({'pagesize': BLOCKSIZE, 'pages': manifest}, outfile)
+        except OSError:
+            print(traceback.format_exc())
+
+
+    def _changedpages(self, pages):
+        ''' The pages that differ on the device (compared by manifest, else read back) '''
+        manifest = self._readmanifest()
+        changed = []
+        for blk in pages:
+            if manifest.get(blk) == self._pagehash(blk):
+                continue
+            wanted = self._pagedata(blk)
+            if self._readpage(blk, len(wanted)) != wanted:
+                changed.append(blk)
+        return changed
+
+
+    def _verify(self, pages):
+        ''' Read the flashed pages back; the pages that are not as in the hex file '''
+        return [blk for blk in pages
+                if self._readpage(blk, len(self._pagedata(blk))) != self._pagedata(blk)]
+
+
     def start_cl(self, displayfunction = None):
-        ''' Commandline interface '''
+        ''' Commandline interface; returns 0: flashed, 1: failed, 2: cancelled '''
         self.dspfunction = displayfunction
         if self.dspfunction:
             self.dspfunction( "Loading %s" % self.hexfile, Recv=None )
-        length = self.datafile.readfile()
-        maxblocknumber = length / BLOCKSIZE
-        block = 0
-        self.serial.dtr = True   # give a hardware reset!
-        self.serial.rts = True   # give a hardware reset!
-        time.sleep(0.4)                     # wait 500 ms
+        if not self._loaded:
+            self.datafile.readfile()
+            self._loaded = True
+        self.retries = 0
+        pages = self.datafile.pages(BLOCKSIZE)      # only the pages with data (of the flash)
+        if self.datafile.endaddress > MAXFLASH:
+            if self.dspfunction:
+                self.dspfunction("Image too large for the bootloader (%X)" % self.datafile.endaddress)
+            self.stop()         # release the connection (A must!)
+            return 1
+        self._setResetLines(True)   # give a hardware reset!
+        time.sleep(RESETTIME)
         if not self._pingpresence():
             if self.dspfunction:
                 self.dspfunction("Connection to device not present")
@@ -164,25 +335,114 @@ class Bootload(object):
             return 1
         #connected
         #print "Flashing"
-        while block <= maxblocknumber:
+        begin = time.monotonic()
+        allpages = pages
+        if self.differential:
+            pages = self._changedpages(allpages)
+        comparetime = time.monotonic() - begin
+        self._forgetmanifest(pages)     # a cancelled or failed flash leaves them unknown
+        length = 0
+        for number, block in enumerate(pages):
+            if self.cancelevent and self.cancelevent.is_set():
+                if self.dspfunction:
+                    self.dspfunction("Flashing cancelled after %d of %d pages; flash again"
+                                     % (number, len(pages)))
+                self.stop()         # release the connection (A must!)
+                return 2
             if self.dspfunction:
-                self.dspfunction("%3d%%,  Flashaddress %04X" % ((100*block)/maxblocknumber, (block * BLOCKSIZE)))
+                self.dspfunction("%3d%%,  Flashaddress %04X" % ((100*number)/len(pages), (block * BLOCKSIZE)))
             if not self._sendblock(block):
                 if self.dspfunction:
                     self.dspfunction("Flashing not succeeded")
                 self.stop()         # release the connection (A must!)
                 return 1
-            block += 1
+            length += len(self._pagedata(block))
+        self.flashtime = time.monotonic() - begin
+        self.bytespersecond = length / max(self.flashtime, 1e-6)
+        self.skipped = len(allpages) - len(pages)
+        message = "Flashed SUCCESSFUL (%d pages, %d bytes in %.1f s, %.0f bytes/s)" \
+                  % (len(pages), length, self.flashtime, self.bytespersecond)
+        if self.differential:
+            if self._verify(pages):
+                if self.dspfunction:
+                    self.dspfunction("Verification not succeeded")
+                self.stop()         # release the connection (A must!)
+                return 1
+            # a page costs its line time and programming; the comparison is the price
+            pagetime = (self.flashtime - comparetime) / len(pages) if pages else \
+                       (BLOCKSIZE + 12) * 10.0 / BAUDRATE + PAGEWRITETIME
+            self.saved = self.skipped * pagetime - comparetime
+            message += ", %d pages unchanged (%.1f s saved), verified" % (self.skipped, self.saved)
+        self._writemanifest(allpages)
         if self.dspfunction:
-            self.dspfunction("Flashed SUCCESSFUL")
+            self.dspfunction(message)
         #print("Successful")
         self.sendCommand(STK_LEAVE_PROGMODE, None)
-        # We do not wait for verification, just leave the bootloading!
+        self._response()    # We do not wait for verification, just leave the bootloading!
         self.stop()         # release the connection (A must!)
-        time.sleep(0.5) # show message
         return 0
 
 
+def usbPorts():
+    ''' The serial ports on USB (as preferred by measuring.getDeviceList) '''
+    return [p.device for p in serial.tools.list_ports.comports() if p.description.find("USB") >= 0]
+
+
+def _flashBoard(hexfile, datafile, port, differential, attempts, displayfunction):
+    ''' worker of flashFleet: one board; gives its row of the summary '''
+    result = {'port': port, 'success': False, 'seconds': 0.0, 'attempts': 0, 'retries': 0}
+    display = None
+    if displayfunction:
+        display = lambda text, Recv = None: displayfunction(port, text)
+    begin = time.monotonic()
+    while result['attempts'] < attempts and not result['success']:
+        result['attempts'] += 1
+        try:
+            application = Bootload(hexfile, port, differential, datafile = datafile)
+            result['success'] = application.start_cl(display) == 0
+            result['retries'] += application.retries
+        except:
+            # port not present or lost: this board fails, the others go on
+            if displayfunction:
+                displayfunction(port, traceback.format_exc().splitlines()[-1])
+    result['seconds'] = time.monotonic() - begin
+    return result
+
+
+def flashFleet(hexfile, ports, differential = False, workers = None,
+               attempts = FLEETATTEMPTS, displayfunction = None):
+    ''' Flash the boards on all ports at the same time
+        The hex file is read once; a thread per port (up to workers), as the
+        flashing is waiting on the serial lines.
+        displayfunction(port, text): the messages of every board
+        returns per port (in the order of ports) a dict with port, success,
+        seconds, attempts and retries (pages sent again); see fleetTable
+    '''
+    datafile = HexFile(hexfile)
+    datafile.readfile()
+    with ThreadPoolExecutor(max_workers = workers or max(len(ports), 1)) as pool:
+        return list(pool.map(lambda port: _flashBoard(hexfile, datafile, port, differential,
+                                                      attempts, displayfunction), ports))
+
+
+def fleetTable(results):
+    ''' The summary of flashFleet as lines of text '''
+    lines = ['%-24s %-7s %8s %8s %7s' % ('Port', 'Result', 'Seconds', 'Attempts', 'Retries')]
+    for result in results:
+        lines.append('%-24s %-7s %8.1f %8d %7d' % (result['port'],
+                                                   'OK' if result['success'] else 'FAILED',
+                                                   result['seconds'], result['attempts'],
+                                                   result['retries']))
+    lines.append('%d of %d boards flashed' % (sum(r['success'] for r in results), len(results)))
+    return lines
+
+
+def _showFleet(port, text):
+    ''' The messages of a fleet flash, without the progress of every page '''
+    if 'Flashaddress' not in text:
+        print('%s: %s' % (port, text))
+
+
 # Test and independent actions
 def main():
     ''' Starts the application '''
@@ -194,8 +454,18 @@ def main():
                     help = "The Intel-hex file to be flashed (without the "'".hex"'")",
                     default = '')
     parser.add_option("-p", "--port", dest = "port",
-                      help = "Serial port for programming",
+                      help = "Serial port for programming; more ports separated by commas, "
+                             "or 'usb' for all USB ports, flash a fleet",
                       default = "COM1")
+    parser.add_option("-j", "--jobs", dest = "jobs", type = "int",
+                      help = "Number of boards flashed at the same time (fleet, default all)",
+                      default = None)
+    parser.add_option("-d", "--differential", dest = "differential", action = "store_true",
+                      help = "Flash only the pages that differ on the device",
+                      default = False)
+    parser.add_option("-n", "--serial", dest = "serialnumber",
+                      help = "Serial number of the device (for its page hashes with -d)",
+                      default = None)
 
     orgargs = sys.argv
     (options, args) = parser.parse_args()
@@ -211,8 +481,20 @@ def main():
         if options.hexfile == '':
             options.hexfile = args[0]
 
-    application = Bootload(options.hexfile, options.port)
-    if application.start_cl() != 0:
+    ports = usbPorts() if options.port.lower() == 'usb' else \
+            [port for port in options.port.split(',') if port]
+    if options.port.lower() == 'usb' or len(ports) > 1:
+        begin = time.monotonic()
+        results = flashFleet(options.hexfile, ports, options.differential, options.jobs,
+                             displayfunction = _showFleet)
+        print('\n'.join(fleetTable(results)))
+        print('Fleet flashed in %.1f s' % (time.monotonic() - begin))
+        if not results or not all(result['success'] for result in results):
+            sys.exit(1)
+        return
+
+    application = Bootload(options.hexfile, options.port, options.differential, options.serialnumber)
+    if application.start_cl(lambda text, Recv = None: print(text)) != 0:
         sys.exit(1)
 
 
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+'''
+Calibration of the measurements
+-------------------------------
+
+The ADC values of the stimulator are 8 bits (ADCH), so every conversion to
+engineering units is a lookup: per channel a table of the 256 float values
+and of the 256 formatted texts is made once, and again only when the
+calibration changes. 0xFF means 'not measured' (StoreADC): NaN and '--'.
+
+The 12 values of a pulse (auAnalogValues) are 4 phases of 3 channels:
+current (mA), full voltage (V) and tissue voltage (V).
+'''
+import numpy as np
+
+from pulsebuffer import ADCVALUES
+
+CURRENT = 0
+FULLVOLTAGE = 1
+TISSUEVOLTAGE = 2
+CHANNELS = 3
+NOTMEASURED = 0xFF
+
+# default calibrations (should go to an array, recalled from device
+CalibrationCURRENTNUL = 127
+CalibrationCURRENT = 0.156
+CalibrationFVNUL = 128
+CalibrationFV = 0.040
+CalibrationTVNUL = 128
+CalibrationTV = 0.041
+
+
+class Calibration(object):
+    ''' Lookup tables from raw ADC value to engineering units '''
+
+    def __init__(self, parameters = (CalibrationCURRENTNUL, CalibrationCURRENT,
+                                     CalibrationFVNUL, CalibrationFV,
+                                     CalibrationTVNUL, CalibrationTV)):
+        ''' constructor; parameters: (zero, gain) for current, full voltage and tissue voltage '''
+        self.parameters = None
+        self.values = None          # [channel, raw] float
+        self.texts = None           # [channel][raw] '%.2f' text
+        self._columns = None        # [column of a pulse, raw] float
+        self.set(parameters)
+
+
+    def set(self, parameters):
+        ''' Change the calibration and rebuild the tables '''
+        parameters = tuple(float(p) for p in parameters)
+        if parameters == self.parameters:
+            return
+        raw = np.arange(256, dtype=np.float64)
+        values = np.empty((CHANNELS, 256), dtype=np.float64)
+        for channel in range(CHANNELS):
+            zero, gain = parameters[2 * channel:2 * channel + 2]
+            values[channel] = (raw - zero) * gain
+        values[:, NOTMEASURED] = np.nan
+        self.values = values
+        self.texts = [['--' if raw == NOTMEASURED else '%.2f' % value
+                       for raw, value in enumerate(values[channel])] for channel in range(CHANNELS)]
+        self._columns = values[np.arange(ADCVALUES) % CHANNELS]
+        self.parameters = parameters
+
+
+    def text(self, channel, raw):
+        ''' The formatted value of one raw ADC value '''
+        return self.texts[channel][raw]
+
+
+    def convert(self, raw):
+        ''' Engineering units of a batch of pulses: raw is an (N, 12) uint8 array
+            (or bytes of N*12 values); gives an (N, 12) float array
+        '''
+        raw = np.asarray(raw if not isinstance(raw, (bytes, bytearray, memoryview))
+                         else np.frombuffer(raw, dtype=np.uint8)).reshape(-1, ADCVALUES)
+        return self._columns[np.arange(ADCVALUES), raw]
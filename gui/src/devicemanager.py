@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+'''
+Multi-device manager
+--------------------
+
+Drives a rack of stimulators from one thread: all ports are opened and
+watched in one selector loop (ports without a file descriptor, as on
+Windows, are polled every TIMEDELAY).
+
+Every device is asked for its serial number ('sn') once it is ready:
+opening the port resets a board (DTR), so its prompt or banner is awaited
+first (up to READYWAIT), as Measure.waitReady does; the question is
+repeated until it is answered. The received lines are routed to the
+handler registered for that serial number:
+
+    manager = DeviceManager()
+    manager.setHandler('123', function)     # function(serialnumber, line)
+    manager.start()
+    manager.SendRequest('123', 'ru')
+
+Lines from devices without a known serial number (or without a handler) go
+to the default handler. statistics() gives per device the throughput and
+the lag between the arrival of data and the handling of its lines.
+'''
+import os
+import time
+import queue
+import threading
+from threading import Thread
+import selectors
+import traceback
+
+from measuring import RETRYCOUNT, READYWAIT, READYMARKS, RETRYTIME, STARTUPTIME, \
+                      getDeviceList, openPort, frameLines
+from protocol import parse, MeasurementEvent, SerialEvent
+
+ASKTIME = 1.0       # s; the serial number is asked this often after STARTUPTIME
+
+
+class Device(object):
+    ''' The state of one port within the DeviceManager '''
+    def __init__(self, port, bus):
+        ''' constructor '''
+        self.port = port
+        self.bus = bus
+        self.serialnumber = None
+        self.connected = True
+        self.opened = time.monotonic()          # opening the port resets the board
+        self.ready = False                      # prompt, banner or measurements seen
+        self.asked = None                       # last time the serial number was asked
+        self.rxbuffer = bytearray()             # received bytes, not yet a complete line
+        self.writelock = threading.Lock()
+        self.lines = 0                          # statistics
+        self.bytes = 0
+        self.lag = 0.0                          # arrival to handled, last and maximal (s)
+        self.maxlag = 0.0
+
+
+class DeviceManager(Thread):
+    ''' classdocs DeviceManager
+    One thread for all stimulators on this host
+    '''
+    TIMEDELAY = 0.005  # polling time for ports without a file descriptor
+
+    def __init__(self, ports = None, baudrate = 38400):
+        ''' Constructor; opens all ports (default: all ports of getDeviceList) '''
+        Thread.__init__(self, name="Stimulator-manager", daemon=True)
+        if ports is None:
+            ports = getDeviceList()[0]
+        self.devices = []
+        self.defaulthandler = None
+        self._handlers = {}                     # serial number: handler
+        self._polled = []                       # devices without a file descriptor
+        self._lost = queue.Queue()              # devices with a failed write, for the loop
+        self._selector = selectors.DefaultSelector()
+        self._wakeup = os.pipe()                # self-pipe to stop the waiting
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ)
+        self._stopevent = threading.Event()
+        self._begin = time.monotonic()
+        for port in ports:
+            self._open(port, baudrate)
+
+
+    def _open(self, port, baudrate):
+        ''' Try to open a port (RETRYCOUNT times) and add it to the loop '''
+        for retry in range(RETRYCOUNT):
+            try:
+                bus = openPort(port, baudrate, timeout=0)
+                break
+            except:
+                #All exceptions are trapped: not only serial, but also 'os' (wrong port name, etc)
+                if retry + 1 >= RETRYCOUNT:
+                    print("Serial %s didn't start, check configuration!" % port)
+                    print(traceback.format_exc())
+                    return None
+                time.sleep(0.1)
+        device = Device(port, bus)
+        try:
+            self._selector.register(bus.fileno(), selectors.EVENT_READ, device)
+        except:     # no fileno on Windows and on the simulated ports
+            self._polled.append(device)
+        self.devices.append(device)
+        return device
+
+
+    def setHandler(self, serialnumber, handler):
+        ''' Connect a handler(serialnumber, line) to the device with this serial number '''
+        self._handlers[serialnumber] = handler
+
+
+    def setDefaultHandler(self, handler):
+        ''' Handler(serialnumber, line) for all lines without a specific handler '''
+        self.defaulthandler = handler
+
+
+    def getDevice(self, serialnumber):
+        ''' The device with the serial number (or port name); None if not present '''
+        for device in self.devices:
+            if serialnumber in (device.serialnumber, device.port):
+                return device
+        return None
+
+
+    def SendRequest(self, serialnumber, reqtype):
+        ''' Send a request message to the device with the serial number (or port name) '''
+        device = self.getDevice(serialnumber)
+        if device and device.connected:
+            self._write(device, reqtype)
+
+
+    def _write(self, device, reqtype):
+        ''' write a request to one device '''
+        with device.writelock:
+            try:
+                device.bus.write((reqtype + '\n\r').encode())
+            except:
+                # the loop takes it out of the selector (not from the caller's thread)
+                self._lost.put(device)
+                os.write(self._wakeup[1], b'x')
+
+
+    def start(self):
+        ''' Start the loop; it asks every device for its serial number when ready '''
+        self._begin = time.monotonic()
+        Thread.start(self)
+
+
+    def stop(self):
+        ''' Stopping this thread and closing all ports '''
+        self._stopevent.set()
+        os.write(self._wakeup[1], b'x')        # wake up the waiting thread
+
+
+    def run(self):
+        ''' The loop: wait on all ports, read and route the complete lines '''
+        while not self._stopevent.is_set():
+            timeout = self._identify()
+            if self._polled:
+                timeout = min(timeout or DeviceManager.TIMEDELAY, DeviceManager.TIMEDELAY)
+            ready = self._selector.select(timeout)
+            arrival = time.monotonic()
+            for key, _events in ready:
+                if key.data is None:
+                    os.read(self._wakeup[0], 64)
+                else:
+                    self._getdata(key.data, arrival)
+            for device in list(self._polled):
+                self._getdata(device, arrival)
+            while not self._lost.empty():
+                self._disconnected(self._lost.get())
+        for device in self.devices:
+            try:
+                device.bus.close()
+            except:
+                pass
+        self._selector.close()
+        os.close(self._wakeup[0])
+        os.close(self._wakeup[1])
+
+
+    def _identify(self):
+        ''' Ask the ready devices without a serial number for it (echo off first),
+            every RETRYTIME during STARTUPTIME and every ASKTIME after that.
+            Returns the time (s) until the next question; None: nothing to ask
+        '''
+        now = time.monotonic()
+        timeout = None
+        for device in self.devices:
+            if device.serialnumber is not None or not device.connected:
+                continue
+            if not device.ready and now < device.opened + READYWAIT:
+                wait = device.opened + READYWAIT - now     # nothing into the bootloader
+            else:
+                interval = RETRYTIME if now < device.opened + STARTUPTIME else ASKTIME
+                if device.asked is None or now >= device.asked + interval:
+                    self._write(device, 'eo')
+                    self._write(device, 'sn')
+                    device.asked = now
+                wait = device.asked + interval - now
+            timeout = wait if timeout is None else min(timeout, wait)
+        return timeout
+
+
+    def _getdata(self, device, arrival):
+        ''' Read everything waiting on one device and handle its complete lines
+            arrival: the moment the loop woke up for this data
+        '''
+        try:
+            waiting = device.bus.in_waiting
+            data = device.bus.read(waiting if waiting > 0 else 1)
+        except:     # disconnection
+            self._disconnected(device)
+            return
+        if len(data) == 0:
+            return
+        device.bytes += len(data)
+        device.rxbuffer += data
+        if not device.ready and any(device.rxbuffer.find(mark) >= 0 for mark in READYMARKS):
+            device.ready = True
+        lines = frameLines(device.rxbuffer)
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            event = parse(line)
+            if isinstance(event, MeasurementEvent):
+                device.ready = True             # running already (not reset)
+            elif isinstance(event, SerialEvent):
+                device.serialnumber = event.serial
+            handler = self._handlers.get(device.serialnumber, self.defaulthandler)
+            if handler:
+                handler(device.serialnumber, line)
+            device.lines += 1
+        if lines:
+            device.lag = time.monotonic() - arrival
+            device.maxlag = max(device.maxlag, device.lag)
+
+
+    def _disconnected(self, device):
+        ''' A port is lost: take it out of the loop (loop thread only) '''
+        if not device.connected:
+            return
+        device.connected = False
+        if device in self._polled:
+            self._polled.remove(device)
+        else:
+            try:
+                self._selector.unregister(device.bus.fileno())
+            except:
+                pass
+
+
+    def statistics(self):
+        ''' Per device: port, serial number, connected, lines, bytes, lines/s, bytes/s and lag (ms) '''
+        elapsed = max(time.monotonic() - self._begin, 1e-6)
+        return [{'port': device.port,
+                 'serial': device.serialnumber,
+                 'connected': device.connected,
+                 'lines': device.lines,
+                 'bytes': device.bytes,
+                 'linespersecond': device.lines / elapsed,
+                 'bytespersecond': device.bytes / elapsed,
+                 'lag': device.lag * 1000,
+                 'maxlag': device.maxlag * 1000} for device in self.devices]
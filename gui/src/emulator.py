@@ -0,0 +1,672 @@
+# -*- coding: utf-8 -*-
+'''
+Emulator of the stimulator firmware
+-----------------------------------
+
+Runs the firmware (terminal.c, waveform.c) as a thread behind a pseudo
+terminal (Linux), so measuring, the GUI and the benchmarks can be used
+without a board. The host opens `emulator.port` as a serial port.
+
+  - terminal: the commands HE VE SN EO GS RE NR RU OF SS SV ST SC WR BO with
+              the responses of the firmware, byte for byte (echo and prompt
+              until EO, upper case input, the 96 byte receive buffer)
+  - waveform: T0 start delay (ms), the pulse T1, T2, T3 (0.1 ms, the device
+              is busy meanwhile) and T4 the pause (ms) until the next pulse;
+              after every pulse a ': ' line with 12 ADC values of a resistive
+              load (see calibration)
+  - serial:   output at 38400 baud through the 128 byte transmit buffer
+  - faults:   dropped bytes and garbage (>0x7F) in the output, disconnects
+              (the port disappears; afterwards the device starts again as
+              after a power up)
+
+All device times (and the baud rate) are divided by `speedup`; the duration
+of a disconnect is not. With a bootloader (bootemulator.Optiboot) the device
+can be flashed during the wait after every reset (BO, power up).
+
+    emulator = FirmwareEmulator(link='/tmp/stimulator', speedup=10)
+    emulator.start()
+    meas = Measure(emulator.port)
+
+From the command line (runs until Ctrl-C):
+
+    python emulator.py -l /tmp/stimulator -x 10 -d 0.001 -g 0.001 -c 30
+'''
+import os
+import sys
+import tty
+import time
+import queue
+import random
+import select
+import optparse
+import threading
+
+from calibration import CalibrationCURRENTNUL, CalibrationCURRENT, CalibrationFVNUL, \
+                        CalibrationFV, CalibrationTVNUL, CalibrationTV
+
+VERSION = 'Stimulator Version 3.00.00'
+BAUDRATE = 38400
+RXBUFFER = 96                   # SERIAL_RXBUFFERSIZE
+TXBUFFER = 128                  # SERIAL_TXBUFFERSIZE
+MAXINPUTLENGTH = 64
+BOOTTIME = 1.0                  # s from reset until the banner (bootloader waiting)
+MAXWAIT = 0.05                  # s; longest wait in the loop (reaction on the control calls)
+
+BS = 0x08
+BELL = 0x07
+CR = 0x0D
+SPACES = ',: \n\t\0'            # fIsSpace
+
+DEFAULTSETTINGS = (0, 0, (25, 25), (1000, 50, 50, 50, 1000))   # vInitWaveform
+HELP = ('HE  HElp',
+        'VE  Show VErsion',
+        'SN  Show Serial Number',
+        'EO  Set Echo Off (for automation)',
+        'GS  Get Status on/offs',
+        'RE  REcording on',
+        'NR  NoRecording (off)',
+        'RU  RUn; Start pulses',
+        'OF  Set output OFf',
+        'BO  BOot/reset (firmware update)',
+        'SS  Show Settings',
+        'SV  <0..50>,<0..50> Set Voltage; pos. and neg. pulse',
+        'ST  <0..65535>,..,<0..65535> Set Timing; 5 timing parms',
+        'SC  <0..65535> Set Calibration',
+        'WR  Write/store all settings')
+
+
+def readUint(text, position):
+    ''' read_uint: (value or None, position of the first non digit); at most
+        5 digits count, the value wraps as an uint16
+    '''
+    value = 0
+    digits = 0
+    while position < len(text) and text[position].isdigit():
+        digits += 1
+        if digits <= 5:
+            value = (value * 10 + int(text[position])) & 0xFFFF
+        position += 1
+    return (value if digits else None), position
+
+
+class PseudoTerminal(object):
+    ''' The device side of a pseudo terminal; the host opens `port`
+        (the link, when given, points to the current terminal)
+    '''
+
+    def __init__(self, link = None):
+        ''' constructor; open() creates the terminal '''
+        self.link = link
+        self.name = None
+        self.master = None
+        self._slave = None
+
+
+    @property
+    def port(self):
+        ''' the name for the host '''
+        return self.link or self.name
+
+
+    def open(self):
+        ''' Create the terminal (raw, no echo of the line discipline) '''
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)         # kept open: no EIO while the host is not connected
+        os.set_blocking(self.master, False)
+        self.name = os.ttyname(self._slave)
+        if self.link:
+            temporary = self.link + '.new'
+            os.symlink(self.name, temporary)
+            os.replace(temporary, self.link)
+
+
+    def close(self):
+        ''' Remove the terminal; the host gets an error on its port '''
+        if self.link:
+            try:
+                os.unlink(self.link)
+            except OSError:
+                pass
+        for fd in (self.master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self._slave = None
+
+
+    def read(self):
+        ''' what the host has written (b'' if nothing) '''
+        try:
+            return os.read(self.master, 4096)
+        except OSError:         # nothing waiting (EAGAIN)
+            return b''
+
+
+    def write(self, data):
+        ''' Send to the host; what does not fit (host not reading) is lost; returns the sent count '''
+        try:
+            return os.write(self.master, data)
+        except OSError:
+            return 0
+
+
+class FirmwareEmulator(threading.Thread):
+    ''' classdocs FirmwareEmulator
+    The firmware of the stimulator behind a pseudo terminal
+    '''
+
+    def __init__(self, link = None, speedup = 1.0, serial = 1, droprate = 0.0, garbagerate = 0.0,
+                 disconnectevery = None, disconnecttime = 1.0, load = 1000.0, seed = None,
+                 bootloader = None):
+        ''' Constructor; the terminal exists at once, the firmware starts with start()
+            droprate, garbagerate: probability per sent byte
+            disconnectevery: s between automatic disconnects of disconnecttime s (None: no)
+            load: resistance of the tissue in ohm
+            bootloader: served after every reset (bootemulator.Optiboot); None: no flashing
+        '''
+        threading.Thread.__init__(self, name="Stimulator-emulator", daemon=True)
+        self.speedup = float(speedup)
+        self.droprate = droprate
+        self.garbagerate = garbagerate
+        self.disconnectevery = disconnectevery
+        self.disconnecttime = disconnecttime
+        self.load = load
+        self.bootloader = bootloader
+        self.serialnumber = serial & 0xFFFF          # eeprom
+        self.stored = None                           # eeprom copy of the settings (WR); None: erased
+        self.pulsecount = 0                          # statistics
+        self.sentbytes = 0
+        self.droppedbytes = 0
+        self.garbagebytes = 0
+        self.overflowbytes = 0                       # lost in the receive buffer
+        self.lostbytes = 0                           # not read by the host in time
+        self.disconnects = 0
+        self.boots = 0
+        self._random = random.Random(seed)
+        self._stopevent = threading.Event()
+        self._actions = queue.Queue()                # calls from other threads, run in the loop
+        self._pty = PseudoTerminal(link)
+        self._pty.open()
+        self._charrate = BAUDRATE / 10.0 * self.speedup    # characters per second (8N1)
+        self._tx = bytearray()
+        self._txmark = 0.0
+        self._rx = bytearray()
+        self._input = ''
+        self._echo = 1
+        self._state = 0
+        self._current = 0.0
+        self._epoch = time.monotonic()
+        self._loadSettings()
+
+
+    @property
+    def port(self):
+        ''' the port name for the host '''
+        return self._pty.port
+
+
+    def stop(self):
+        ''' End the emulation and remove the terminal '''
+        self._stopevent.set()
+
+
+    def disconnect(self, duration = None):
+        ''' Let the port disappear for duration s (default disconnecttime) '''
+        self._actions.put(lambda: self._disconnect(self.disconnecttime if duration is None else duration))
+
+
+    def pressRun(self):
+        ''' The run button (vChangeRunState) '''
+        self._actions.put(self._changeRun)
+
+
+    def pressRecord(self):
+        ''' The record button (vChangeRecState) '''
+        self._actions.put(self._changeRecord)
+
+
+    def statistics(self):
+        ''' counters of the emulation '''
+        return {'pulses': self.pulsecount, 'sent': self.sentbytes, 'dropped': self.droppedbytes,
+                'garbage': self.garbagebytes, 'overflow': self.overflowbytes,
+                'lost': self.lostbytes, 'disconnects': self.disconnects, 'boots': self.boots}
+
+
+    def _clock(self):
+        ''' the system timer of the device in ms '''
+        return (time.monotonic() - self._epoch) * 1000.0 * self.speedup
+
+
+    def _sleep(self, ms):
+        ''' busy in the device for ms (output keeps going, input waits) '''
+        end = time.monotonic() + ms / 1000.0 / self.speedup
+        while not self._stopevent.is_set():
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            self._transmit()
+            time.sleep(min(remaining, MAXWAIT, 0.001 if self._tx else MAXWAIT))
+
+
+    def run(self):
+        ''' The round robin loop of the firmware '''
+        nextdisconnect = time.monotonic() + self.disconnectevery if self.disconnectevery else None
+        self._boot()
+        while not self._stopevent.is_set():
+            while not self._actions.empty():
+                self._actions.get()()
+            if nextdisconnect and time.monotonic() >= nextdisconnect:
+                self._disconnect(self.disconnecttime)
+                nextdisconnect = time.monotonic() + self.disconnectevery
+            try:
+                select.select([self._pty.master], [], [], self._timeout())
+            except (OSError, ValueError):
+                pass
+            self._receive()
+            self._doTerminal()
+            self._doWaveform()
+            self._transmit()
+        self._pty.close()
+
+
+    def _timeout(self):
+        ''' time (s) until the loop has something to do '''
+        if self._tx:
+            return min(MAXWAIT, max(0.0005, len(self._tx) / self._charrate))
+        if self._state == 2 or (self._state == 0 and self._start == 1):
+            return 0.0
+        if self._state == 1:
+            wait = self._current + self._times[0] - self._clock()
+        elif self._state == 3:
+            wait = self._current + self._times[4] - self._clock()
+        else:
+            return MAXWAIT
+        return min(MAXWAIT, max(0.0, wait / 1000.0 / self.speedup))
+
+
+    def _boot(self):
+        ''' Reset: the bootloader waits, then vSetup (settings from the eeprom, banner) '''
+        self.boots += 1
+        self._tx.clear()
+        self._rx.clear()
+        self._input = ''
+        if self.bootloader:
+            self.bootloader.serve(self._pty, BOOTTIME / self.speedup, self._stopevent)
+        end = time.monotonic() + (0.0 if self.bootloader else BOOTTIME / self.speedup)
+        while not self._stopevent.is_set() and time.monotonic() < end:
+            time.sleep(min(MAXWAIT, max(0.0, end - time.monotonic())))
+            self._pty.read()                # not for the firmware
+        self._epoch = time.monotonic()
+        self._state = 0
+        self._loadSettings()
+        self._echo = 1
+        self._put('\r\nCommand terminal for stimulator\r\n' + VERSION + '\r\n')
+        self._prompt()
+
+
+    def _loadSettings(self):
+        ''' vInitWaveform '''
+        start, record, voltages, times = self.stored or DEFAULTSETTINGS
+        self._start = start
+        self._record = record
+        self._voltages = list(voltages)
+        self._times = list(times)
+
+
+    def _disconnect(self, duration):
+        ''' The port disappears for duration s; then a power up '''
+        self.disconnects += 1
+        self._pty.close()
+        self._stopevent.wait(duration)
+        self._pty.open()
+        self._boot()
+
+
+    # ---- serial -------------------------------------------------------------------------
+
+    def _put(self, text):
+        ''' vSerialPutChar for a string: waits while the transmit buffer is full '''
+        self._tx += text.encode('ascii')
+        while len(self._tx) > TXBUFFER and not self._stopevent.is_set():
+            time.sleep(min(MAXWAIT, (len(self._tx) - TXBUFFER) / self._charrate))
+            self._transmit()
+
+
+    def _transmit(self):
+        ''' Send what the baud rate allows since the last call '''
+        now = time.monotonic()
+        if not self._tx:
+            self._txmark = now
+            return
+        count = int((now - self._txmark) * self._charrate)
+        if count <= 0:
+            return
+        data = bytes(self._tx[:count])
+        del self._tx[:count]
+        self._txmark += count / self._charrate
+        if self.droprate or self.garbagerate:
+            data = self._damage(data)
+        if data and self._pty.master is not None:
+            sent = self._pty.write(data)
+            self.sentbytes += sent
+            self.lostbytes += len(data) - sent
+
+
+    def _damage(self, data):
+        ''' the injected faults: dropped bytes, garbage bytes (>0x7F) '''
+        damaged = bytearray()
+        for byte in data:
+            if self._random.random() < self.garbagerate:
+                damaged.append(self._random.randrange(0x80, 0x100))
+                self.garbagebytes += 1
+            if self._random.random() < self.droprate:
+                self.droppedbytes += 1
+            else:
+                damaged.append(byte)
+        return bytes(damaged)
+
+
+    def _receive(self):
+        ''' The receive interrupt: what does not fit in the buffer is lost '''
+        if self._pty.master is None:
+            return
+        data = self._pty.read()
+        room = RXBUFFER - len(self._rx)
+        self._rx += data[:room]
+        self.overflowbytes += max(0, len(data) - room)
+
+
+    # ---- terminal.c ---------------------------------------------------------------------
+
+    def _prompt(self):
+        ''' vShowPrompt '''
+        if self._echo:
+            self._put('TERM> ')
+        self._input = ''
+
+
+    def _echochar(self, char):
+        ''' vEchoChar '''
+        if self._echo:
+            self._put(char)
+
+
+    def _doTerminal(self):
+        ''' vDoTerminal for every received character '''
+        while self._rx:
+            char = chr(self._rx.pop(0))
+            if ord(char) == BS:
+                if self._input:
+                    self._echochar('\b \b')
+                    self._input = self._input[:-1]
+                else:
+                    self._echochar(chr(BELL))
+            elif ord(char) == CR:
+                self._echochar('\r\n')
+                boots = self.boots
+                self._parse()
+                if self.boots == boots:     # BO does not return
+                    self._prompt()
+            elif len(self._input) >= MAXINPUTLENGTH:
+                self._echochar(chr(BELL))
+            else:
+                self._echochar(char)
+                self._input += char.upper()
+
+
+    def _parse(self):
+        ''' vParseCommand '''
+        text = self._input
+        position = 0
+        while position < len(text) and text[position] in SPACES:
+            position += 1
+        begin = position
+        while position < len(text) and text[position] not in SPACES:
+            position += 1
+        command = text[begin:position]
+        position += 1
+        while position < len(text) and text[position] in SPACES:
+            position += 1
+        argument = text[position:]
+        if len(command) > 1:
+            for text in HELP:
+                if command[:2] == text[:2]:
+                    getattr(self, '_' + text[:2].lower())(argument)
+                    break
+            else:
+                self._put('Unknown command\r\n')
+                self._he(None)
+
+
+    def _parmError(self, missing):
+        ''' vShowParmError '''
+        self._put('Parameter missing ' if missing else 'Parameter out of bounds ')
+        self._put('error\r\n')
+
+
+    def _status(self):
+        ''' vSendStatus '''
+        self._put('!: %02X %02X\r\r\n' % (self._record, self._start))
+
+
+    def _he(self, _argument):
+        ''' help '''
+        self._put('HELP: First two characters are the command; implemented:\r\n\r\n')
+        for text in HELP:
+            self._put(text + '\r\n')
+
+
+    def _ve(self, _argument):
+        ''' version '''
+        self._put(VERSION + '\r\n')
+
+
+    def _sn(self, argument):
+        ''' show (or store with 'C' after it) the serial number '''
+        value, position = readUint(argument, 0)
+        if value is not None and argument[position:position + 1] == 'C':
+            self.serialnumber = value
+        self._put('Serial:  %d\r\n' % self.serialnumber)
+
+
+    def _eo(self, _argument):
+        ''' echo off '''
+        self._echo = 0
+
+
+    def _bo(self, _argument):
+        ''' reboot through the watchdog '''
+        self._put('Reboot\r\n')
+        self._sleep(60)
+        while self._tx and not self._stopevent.is_set():
+            self._sleep(1)
+        self._boot()
+
+
+    def _gs(self, _argument):
+        ''' status '''
+        self._status()
+
+
+    def _re(self, _argument):
+        ''' recording on '''
+        self._record = 1
+        self._status()
+
+
+    def _nr(self, _argument):
+        ''' recording off '''
+        self._record = 0
+        self._status()
+
+
+    def _ru(self, _argument):
+        ''' run '''
+        self._start = 1
+        self._status()
+
+
+    def _of(self, _argument):
+        ''' off '''
+        self._start = 0
+        self._status()
+
+
+    def _ss(self, _argument):
+        ''' show settings '''
+        self._put('Settings:\r\n')
+        self._put('Voltage V1, V2:         %d, %d\r\n' % tuple(self._voltages))
+        self._put('Timings T0,T1,T2,T3,T4: %s\r\n' % ', '.join('%d' % t for t in self._times))
+
+
+    def _sv(self, argument):
+        ''' set the voltages (0..50 each) '''
+        first, position = readUint(argument, 0)
+        second = None
+        if first is not None:
+            second, position = readUint(argument, position + 1)
+        if second is None:
+            self._parmError(True)
+        elif first > 50 or second > 50:
+            self._parmError(False)
+        else:
+            self._voltages = [first, second]
+
+
+    def _st(self, argument):
+        ''' set the 5 timings '''
+        times = []
+        position = 0
+        for _ in range(5):
+            value, position = readUint(argument, position)
+            if value is None:
+                self._parmError(True)
+                return
+            times.append(value)
+            position += 1
+        self._times = times
+
+
+    def _sc(self, argument):
+        ''' set calibration (not implemented in the firmware either) '''
+        if readUint(argument, 0)[0] is None:
+            self._parmError(True)
+
+
+    def _wr(self, _argument):
+        ''' store the settings (with the flags) '''
+        self._put('Writing to eeprom\r\n')
+        self.stored = (self._start, self._record, tuple(self._voltages), tuple(self._times))
+
+
+    def _changeRun(self):
+        ''' vChangeRunState '''
+        self._start = 0 if self._start else 1
+        self._status()
+
+
+    def _changeRecord(self):
+        ''' vChangeRecState '''
+        self._record = 0 if self._record else 1
+        self._status()
+
+
+    # ---- waveform.c ---------------------------------------------------------------------
+
+    def _doWaveform(self):
+        ''' vDoWaveform '''
+        if self._start == 0 or self._start > 3:
+            self._state = 0
+        now = self._clock()
+        if self._state == 0:
+            if self._start == 1:
+                self._put('START \r\n')
+                self._state = 1
+                self._current = now
+            else:
+                self._start = 0
+        elif self._state == 1:
+            if now - self._current >= self._times[0]:
+                self._start = 2
+                self._current = self._clock()
+                self._state = 2
+        elif self._state == 2:
+            t1, t2, t3 = self._times[1:4]
+            self._sleep((t1 + t2 + t3) / 10.0)
+            self._current = self._clock()
+            self._state = 3
+            self.pulsecount += 1
+            # vSendHex ends with '\r', vSendCR follows: ': XX .. XX\r\r\n' (40 bytes)
+            self._put(':' + ''.join(' %02X' % value for value in self._measure()) + '\r\r\n')
+        elif self._state == 3:
+            if now - self._current >= self._times[4]:
+                self._state = 2
+                self._current = self._clock()
+
+
+    def _adc(self, volts, zero, gain):
+        ''' ADCH of a value (with one bit of noise); 0xFF is kept for 'no read' '''
+        return max(0, min(0xFE, int(round(zero + volts / gain + self._random.uniform(-1, 1)))))
+
+
+    def _measure(self):
+        ''' auAnalogValues of one pulse on a resistive load
+            (current, full voltage, tissue voltage for pulse, rest, negative pulse, rest)
+        '''
+        values = []
+        for volts in (self._voltages[0] / 10.0, -self._voltages[1] / 10.0):
+            tissue = 0.8 * volts
+            values += [self._adc(tissue / self.load * 1000.0, CalibrationCURRENTNUL, CalibrationCURRENT),
+                       self._adc(volts, CalibrationFVNUL, CalibrationFV),
+                       self._adc(tissue, CalibrationTVNUL, CalibrationTV),
+                       self._adc(0.0, CalibrationCURRENTNUL, CalibrationCURRENT),
+                       self._adc(0.05 * volts, CalibrationFVNUL, CalibrationFV),
+                       self._adc(0.1 * tissue, CalibrationTVNUL, CalibrationTV)]
+        if self._times[3] == 0:
+            values[6:] = [0xFF] * 6         # no negative pulse: StoreADC(2) and (3) skipped
+        return values
+
+
+def main():
+    ''' Run an emulated stimulator until Ctrl-C '''
+    parser = optparse.OptionParser(
+        usage = "%prog [options]",
+        description = "Emulated stimulator on a pseudo terminal (Linux)" )
+
+    parser.add_option("-l", "--link", dest = "link",
+                      help = "Name for the port (a link to the pseudo terminal)",
+                      default = None)
+    parser.add_option("-x", "--speedup", dest = "speedup", type = "float",
+                      help = "Device time runs this many times faster",
+                      default = 1.0)
+    parser.add_option("-n", "--serial", dest = "serial", type = "int",
+                      help = "Serial number of the device",
+                      default = 1)
+    parser.add_option("-d", "--drop", dest = "drop", type = "float",
+                      help = "Probability of a dropped byte",
+                      default = 0.0)
+    parser.add_option("-g", "--garbage", dest = "garbage", type = "float",
+                      help = "Probability of a garbage byte (>0x7F)",
+                      default = 0.0)
+    parser.add_option("-c", "--disconnect", dest = "disconnect", type = "float",
+                      help = "Disconnect every so many seconds",
+                      default = None)
+
+    (options, _args) = parser.parse_args()
+
+    emulator = FirmwareEmulator(options.link, options.speedup, options.serial, options.drop,
+                                options.garbage, options.disconnect)
+    emulator.start()
+    print('Emulated stimulator on %s' % emulator.port)
+    try:
+        while emulator.is_alive():
+            emulator.join(1.0)
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    emulator.join(2.0)
+    print(emulator.statistics())
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
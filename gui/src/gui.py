@@ -4,10 +4,15 @@
 #pylint: disable-msg=E0611,E1101,E1103,F0401, E1002, W0105
 #if the designer block isn't compiled these errors will occur
 import os
-import time
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import wait
 from PyQt5 import QtGui, QtCore, QtWidgets
 
 from designer.stimulator import Ui_MilliPillarControl
+from calibration import Calibration, CURRENT, FULLVOLTAGE, TISSUEVOLTAGE
+from protocol import parse, MeasurementEvent, VersionEvent, SerialEvent, StatusEvent, SettingsEvent
 
 
 home = os.path.dirname(__file__)
@@ -15,20 +20,42 @@ home = os.path.dirname(__file__)
 
 RESISTOR = 100.0        #BASE RESISTOR IN OHM (for calibration)
 
-# calibrations (should go to an array, recalled from device
-CalibrationCURRENTNUL = 127
-CalibrationCURRENT = 0.156
-CalibrationFVNUL = 128
-CalibrationFV = 0.040
-CalibrationTVNUL = 128
-CalibrationTV = 0.041
+QUERYTIME = 1.0         # maximal time (s) for the answers on the initial queries
+FRAMETIME = 40          # ms; received lines are shown at most once per frame (25 Hz)
+
+# Shown values of a measurement line: (index in auAnalogValues, channel, screen field)
+MEASURED = ((0, CURRENT, 'TissueAFirst'),
+            (1, FULLVOLTAGE, 'MeasuredFirstEdit'),
+            (2, TISSUEVOLTAGE, 'TissueVFirst'),
+            (5, TISSUEVOLTAGE, 'TissueRestT2'),
+            (6, CURRENT, 'TissueASecond'),
+            (7, FULLVOLTAGE, 'MeasuredSecondEdit'),
+            (8, TISSUEVOLTAGE, 'TissueVSecond'),
+            (11, TISSUEVOLTAGE, 'TissueRestT4'))
+
 
 class MyMainWindow(QtWidgets.QMainWindow):
     ''' classdoc MyMainWindow '''
+    received = QtCore.pyqtSignal()      # from the serial thread: new lines are waiting
+    flashMessage = QtCore.pyqtSignal(str)   # from the flasher thread: progress
+    flashEnded = QtCore.pyqtSignal(int)     # from the flasher thread: 0 flashed, 1 failed, 2 cancelled
+
     def __init__(self, app, methods, parent=None):
         '''  constructor '''
         super().__init__(parent)
         self.stopped = True
+        self._latestlock = threading.Lock()
+        self._latest = OrderedDict()    # field: (text, event), in order of arrival
+        self.received.connect(self._scheduleUpdate)
+        self.flashMessage.connect(self._showStatus)
+        self.flashEnded.connect(self._flashEnded)
+        self._flashtext = ''                # text of the flash button while it cancels
+        self.calibration = Calibration()
+        self._show = {MeasurementEvent: self._showMeasurement,
+                      VersionEvent: self._showVersion,
+                      SerialEvent: self._showSerial,
+                      StatusEvent: self._showButtons,
+                      SettingsEvent: self._showSettings}
         self._app = app
         self.methods = methods
         self.upgradefile = ''
@@ -56,21 +83,37 @@ class MyMainWindow(QtWidgets.QMainWindow):
 
 
     def get_initial_data(self):
-        ''' give the commands to get the initial data
-           Needs some time at beginning for startup after a reset
-           and intermediate for the normal flow of the device.
+        ''' give the commands to get the initial data (from any thread)
+           The version request is repeated until the device answers (startup after a reset);
+           then the other queries are sent at once and their answers awaited.
         '''
-        time.sleep(0.5)
-        self.methods.sendMsg('eo')  # no echos
-        time.sleep(0.05)
-        self.methods.sendMsg('ve')  # show firmwareversion
-        time.sleep(0.05)
-        self.methods.sendMsg('sn')  # show serial number
-        time.sleep(0.05)
-        self.methods.sendMsg('gs')  # show the status of the run/record
-        time.sleep(0.05)
-        self.methods.sendMsg('ss')  # show settings
+        if self.methods.waitReady() is None:
+            self.postSerial('No response from the device')
+            return False
+        queries = [self.methods.request('sn'),  # show serial number
+                   self.methods.request('ss'),  # show settings (before a recording starts)
+                   self.methods.request('gs')]  # show the status of the run/record
+        _, notdone = wait(queries, timeout=QUERYTIME)
+        for future in notdone:
+            future.cancel()             # a lost answer: the next one is not for this query
         #The responses will automatically be shown on screen
+        return not notdone
+
+
+    def queryInitialData(self):
+        ''' get_initial_data in a worker thread: the window goes on while the
+            device starts up (or does not answer)
+        '''
+        threading.Thread(target=self._initialData, name="Stimulator-initial", daemon=True).start()
+
+
+    def _initialData(self):
+        ''' worker of queryInitialData '''
+        try:
+            self.get_initial_data()
+        except:
+            # the port is changed or flashed in between: the new connection asks again
+            traceback.print_exc()
         
 
     def _timingchanged(self):
@@ -145,10 +188,24 @@ class MyMainWindow(QtWidgets.QMainWindow):
 
 
     def _flash(self):
-        ''' run the flasher '''
+        ''' run the flasher in the background; during the flash the button cancels it '''
         #print('flash')
-        self.methods.doReset(str(self.ui.fileNameLineEdit.text()),
-                             str(self.ui.comportsBox.currentText()))
+        if self.methods.flashing():
+            self.methods.cancelFlash()
+            self.ui.FlashButton.setEnabled(False)   # until the current page is done
+            return
+        if self.methods.doReset(str(self.ui.fileNameLineEdit.text()),
+                                str(self.ui.comportsBox.currentText())):
+            self._flashtext = self.ui.FlashButton.text()
+            self.ui.FlashButton.setText('Cancel')
+            self.ui.comportsBox.setEnabled(False)
+
+
+    def _flashEnded(self, _result):
+        ''' the flasher thread is done (the measurement runs again) '''
+        self.ui.FlashButton.setText(self._flashtext)
+        self.ui.FlashButton.setEnabled(True)
+        self.ui.comportsBox.setEnabled(True)
 
 
     def _setCorrFactors(self):  # TODO!
@@ -163,7 +220,7 @@ class MyMainWindow(QtWidgets.QMainWindow):
         for p in comlist:
             self.ui.comportsBox.addItem(p)
         self.ui.comportsBox.setCurrentIndex(preferred)
-        self.get_initial_data()
+        self.queryInitialData()
 
 
     def setBPM(self, time1, time2, time3, time4):
@@ -174,35 +231,13 @@ class MyMainWindow(QtWidgets.QMainWindow):
         self.ui.BPMEdit.setText('%.1f' % bpm)
 
 
-    def readCurrent(self, hexstr, viewElement):
-        ''' Make current out of received hex value
-        '''
-        if hexstr == 'FF':
-            viewElement.setText('--')
-        else:
-            raw = int(hexstr, 16) - CalibrationCURRENTNUL
-            raw = raw * CalibrationCURRENT
-            viewElement.setText('%.2f' % raw)
-        
-    def readFullVoltage(self, hexstr, viewElement):
-        ''' Make voltage out of received hex value
+    def showMeasured(self, values):
+        ''' Show the measured values of one pulse (12 raw ADC values) through the
+            lookup tables of the calibration
         '''
-        if hexstr == 'FF':
-            viewElement.setText('--')
-        else:
-            raw = int(hexstr, 16) - CalibrationFVNUL
-            raw = raw * CalibrationFV
-            viewElement.setText('%.2f' % raw)
-        
-    def readTissVoltage(self, hexstr, viewElement):
-        ''' Make voltage out of received hex value
-        '''
-        if hexstr == 'FF':
-            viewElement.setText('--')
-        else:
-            raw = int(hexstr, 16) - CalibrationTVNUL
-            raw = raw * CalibrationTV
-            viewElement.setText('%.2f' % raw)
+        texts = self.calibration.texts
+        for index, channel, field in MEASURED:
+            getattr(self.ui, field).setText(texts[channel][values[index]])
 
 
     def cleanMeasured(self):
@@ -218,72 +253,92 @@ class MyMainWindow(QtWidgets.QMainWindow):
         self.ui.TissueRestT4.setText('--')
 
         
+    def postSerial(self, text, Recv = None, Event = None):
+        ''' Display function for the serial thread (thread safe)
+            Event: the line parsed by the serial thread (protocol), else Recv is
+            parsed here; only the latest event per screen field is kept, the GUI
+            thread is signalled once and shows the waiting events at the next frame.
+        '''
+        event = Event if Event is not None else (parse(Recv) if Recv else None)
+        field = event.field if event else None
+        with self._latestlock:
+            first = not self._latest
+            self._latest[field] = (text, event)
+            self._latest.move_to_end(field)
+        if first:
+            self.received.emit()
+
+
+    def _scheduleUpdate(self):
+        ''' GUI thread: show the waiting lines at the next frame '''
+        QtCore.QTimer.singleShot(FRAMETIME, self._applyLatest)
+
+
+    def _applyLatest(self):
+        ''' GUI thread: show the latest event of every field '''
+        with self._latestlock:
+            latest = self._latest
+            self._latest = OrderedDict()
+        for text, event in latest.values():
+            self._showStatus(text, event)
+
+
     #pylint: disable=R0913
     def UpdateScrStatus(self, text, Recv = None):
-        ''' Change values on screen in status and progress '''
-        self.ui.statusbar.showMessage(text)
-        if Recv:
-            Recv = Recv.strip()     # remove newlines/CR at front and back
-            if Recv.find('TERM> ') == 0 :
-                Recv = Recv[6:]
-            if Recv.find('Stimulator Version') == 0 :
-                self.ui.FirmwareVersion.setText(Recv[19:])
-            elif Recv.find('Serial:') >= 0:
-                self.ui.SerialNumberEdit.setText(Recv[7:])
-            elif Recv.find('!:') == 0:      # button status for recording and running
-                if Recv[3:5] == '00':
-                    self.ui.pushButton_Recorder.setChecked(False)
-                else:
-                    self.ui.pushButton_Recorder.setChecked(True)
-                if Recv[6:8] == '00':
-                    self.ui.pushButton_Run.setChecked(False)
-                    self.cleanMeasured()
-                else:
-                    self.ui.pushButton_Run.setChecked(True)
-            elif Recv.find('Voltage V1, V2:') == 0:
-                Recv = Recv[16:].strip()
-                Comma = Recv.find(',')
-                Vpos = eval(Recv[:Comma])/10
-                self.ui.FirstVoltageEdit.setText('%.2f' % Vpos) 
-                Vneg = eval(Recv[(Comma+2):])/10
-                self.ui.SecondVoltageEdit.setText('-%.2f' % Vneg)
-            elif Recv.find('Timings T0,T1,T2,T3,T4:') == 0:
-                Recv = Recv[23:].strip() 
-                Comma = Recv.find(',')
-                time0 = int(Recv[:Comma])
-                Recv = Recv[Comma+1:]
-                Comma = Recv.find(',')
-                time1 = int(Recv[:Comma])/10
-                Recv = Recv[Comma+1:]
-                Comma = Recv.find(',')
-                time2 = int(Recv[:Comma])/10
-                Recv = Recv[Comma+1:]
-                Comma = Recv.find(',')
-                time3 = int(Recv[:Comma])/10
-                time4 = int(Recv[Comma+1:])
-                self.ui.StarttimeEdit.setText('%d' % time0)
-                self.ui.TimingT1Edit.setText('%.1f' % time1)
-                self.ui.TimingT2Edit.setText('%.1f' % time2)
-                self.ui.TimingT3Edit.setText('%.1f' % time3)
-                self.ui.TimingT4Edit.setText('%d' % time4)
-                self.setBPM(time1, time2, time3, time4)
-            elif Recv.find(': ') == 0:
-                self.readCurrent(Recv[2:4], self.ui.TissueAFirst)
-                self.readFullVoltage(Recv[5:7], self.ui.MeasuredFirstEdit)
-                self.readTissVoltage(Recv[8:10], self.ui.TissueVFirst)
-                #cur2 = self.readCurrent(Recv[11:13])
-                #vol2 = self.readFullVoltage(Recv[14:16])
-                self.readTissVoltage(Recv[17:19], self.ui.TissueRestT2)
-                self.readCurrent(Recv[20:22], self.ui.TissueASecond)
-                self.readFullVoltage(Recv[23:25], self.ui.MeasuredSecondEdit)
-                self.readTissVoltage(Recv[26:28], self.ui.TissueVSecond)
-                #cur2 = self.readCurrent(Recv[29:31])
-                #vol2 = self.readFullVoltage(Recv[32:34])
-                self.readTissVoltage(Recv[35:37], self.ui.TissueRestT4)
+        ''' Change values on screen in status and progress (GUI thread only) '''
+        self._showStatus(text, parse(Recv) if Recv else None)
         self._app.processEvents()
         return True
 
 
+    def _showStatus(self, text, event = None):
+        ''' Change values on screen in status and measurements '''
+        self.ui.statusbar.showMessage(text)
+        show = self._show.get(type(event))
+        if show:
+            show(event)
+
+
+    def _showMeasurement(self, event):
+        ''' the values of one pulse '''
+        self.showMeasured(event.values)
+
+
+    def _showVersion(self, event):
+        ''' firmware version '''
+        self.ui.FirmwareVersion.setText(event.version)
+
+
+    def _showSerial(self, event):
+        ''' serial number '''
+        self.ui.SerialNumberEdit.setText(event.serial)
+
+
+    def _showButtons(self, event):
+        ''' button status for recording and running '''
+        self.ui.pushButton_Recorder.setChecked(event.recording != 0)
+        self.ui.pushButton_Run.setChecked(event.running != 0)
+        if event.running == 0:
+            self.cleanMeasured()
+
+
+    def _showSettings(self, event):
+        ''' voltages or timings (device units: V1, V2 and T1..T3 in tenths) '''
+        if event.voltages:
+            Vpos, Vneg = event.voltages
+            self.ui.FirstVoltageEdit.setText('%.2f' % (Vpos / 10))
+            self.ui.SecondVoltageEdit.setText('-%.2f' % (Vneg / 10))
+        if event.timings:
+            time0, time1, time2, time3, time4 = event.timings
+            time1, time2, time3 = time1 / 10, time2 / 10, time3 / 10
+            self.ui.StarttimeEdit.setText('%d' % time0)
+            self.ui.TimingT1Edit.setText('%.1f' % time1)
+            self.ui.TimingT2Edit.setText('%.1f' % time2)
+            self.ui.TimingT3Edit.setText('%.1f' % time3)
+            self.ui.TimingT4Edit.setText('%d' % time4)
+            self.setBPM(time1, time2, time3, time4)
+
+
     def show(self):
         ''' Start the constant timer '''
         QtWidgets.QMainWindow.show(self)
@@ -8,11 +8,39 @@ Reading Intel-hex file to memory
 Read the hex file to memory,
 set checksum,
 
+All record types are understood: data (00), end of file (01), extended
+segment and linear addresses (02, 04) and the start addresses (03, 05), so
+images above 64 KB load. Every record's checksum is checked (ValueError on
+a damaged file).
+
+The image is a sorted list of contiguous segments (address, bytearray),
+only as large as the data; what is not in a segment is erased (0xFF).
+Records that continue a segment extend it, overlapping ones are joined.
+As avr-objcopy does, the memories have their own address ranges: flash
+from 0, EEPROM from EEPROM (0x810000); pages() and the begin and end of the
+image concern the flash. Portions are read-only memoryview slices (a copy
+only for a portion over a gap between segments).
+
 '''
 #Created on Jun 27, 2011, 2025
 #author: GHJ Morsink
 
 import sys
+from bisect import bisect_left, bisect_right
+
+DATA = 0x00             # record types
+ENDOFFILE = 0x01
+SEGMENTADDRESS = 0x02
+STARTSEGMENT = 0x03
+LINEARADDRESS = 0x04
+STARTLINEAR = 0x05
+
+FLASH = 0x000000        # address ranges of the memories (avr-objcopy)
+SRAM = 0x800000
+EEPROM = 0x810000
+FUSES = 0x820000
+MEMORIES = (SRAM, EEPROM, FUSES)    # the borders between the memories
+
 
 class HexFile(object):
     ''' Basic Intel hex file structure 
@@ -21,29 +49,81 @@ class HexFile(object):
     def __init__(self, readfilename):
         ''' setup the used structures
         '''
-        self.localmemory = [0xFF for _ in range(0x8000)] #pylint: disable-msg=W0612
-        self.endaddress = 0
-        self.beginaddress = 0x8000
+        self.segments = []          # [address, bytearray] sorted, not touching each other
+        self._starts = []           # address of every segment (for bisect)
+        self.startaddress = None    # from a start address record (03: CS << 16 | IP)
+        self.endaddress = 0         # of the flash data
+        self.beginaddress = 0
         self.inFile = readfilename
 
     def readfile(self):
         '''Read the file to memory'''
-        infile = open( self.inFile, "r", encoding="utf-8")
-        for line in infile.readlines():
-            hexlen = int(line[1:3], 16)
-            hexaddress = int(line[3:7], 16)
-            hextype = line[7:9]
-            if hextype == '00':
-                self.beginaddress = min(self.beginaddress, hexaddress)
-                self.endaddress = max(self.endaddress, hexaddress + hexlen)
-                for item in range(hexlen):
-                    membyte = int(line[(9 + 2*item):(11 + 2*item)], 16)
-                    self.localmemory[hexaddress+item] = membyte
-                    # NOTE: we do not check the line's checksum
-        infile.close()
+        base = 0                    # from the extended address records
+        with open(self.inFile, "r", encoding="utf-8") as infile:
+            for number, line in enumerate(infile, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = bytes.fromhex(line[1:]) if line[0] == ':' else b''
+                except ValueError:
+                    record = b''
+                if len(record) < 5 or len(record) != record[0] + 5:
+                    raise ValueError('%s, line %d: no Intel hex record' % (self.inFile, number))
+                if sum(record) & 0xFF:
+                    raise ValueError('%s, line %d: checksum error' % (self.inFile, number))
+                hexlen = record[0]
+                hexaddress = record[1] << 8 | record[2]
+                hextype = record[3]
+                if hextype == DATA:
+                    self._store(base + hexaddress, record[4:-1])
+                elif hextype == ENDOFFILE:
+                    break
+                elif hextype in (SEGMENTADDRESS, LINEARADDRESS) and hexlen == 2:
+                    value = record[4] << 8 | record[5]
+                    base = value << 4 if hextype == SEGMENTADDRESS else value << 16
+                elif hextype in (STARTSEGMENT, STARTLINEAR) and hexlen == 4:
+                    self.startaddress = int.from_bytes(record[4:8], 'big')
+                else:
+                    raise ValueError('%s, line %d: unknown record' % (self.inFile, number))
+        flash = [(address, address + len(data)) for address, data in self.segments
+                 if address < SRAM]
+        if flash:
+            self.beginaddress = flash[0][0]
+            self.endaddress = flash[-1][1]
         return self.endaddress - self.beginaddress
 
 
+    def _store(self, address, data):
+        ''' Put the data of a record in the segments: continue, join or overwrite '''
+        end = address + len(data)
+        first = bisect_right(self._starts, address) - 1
+        if first >= 0 and first + 1 == len(self.segments) and \
+           len(self.segments[first][1]) >= address - self._starts[first]:
+            # the usual case: the last segment is continued (or overwritten)
+            start, memory = self.segments[first]
+            memory[address - start:end - start] = data
+            return
+        if first < 0 or self._starts[first] + len(self.segments[first][1]) < address:
+            first += 1                              # no segment touches the data from before
+        last = bisect_right(self._starts, end)      # the segments from first to last touch it
+        start = min([address] + self._starts[first:first + 1])
+        stop = max([end] + [segstart + len(memory) for segstart, memory in self.segments[last - 1:last]
+                            if last > first])
+        memory = bytearray(b'\xff' * (stop - start))
+        for segstart, segmemory in self.segments[first:last]:
+            memory[segstart - start:segstart - start + len(segmemory)] = segmemory
+        memory[address - start:end - start] = data
+        self.segments[first:last] = [[start, memory]]
+        self._starts[first:last] = [start]
+
+
+    @property
+    def ranges(self):
+        ''' (begin, end) address of every segment '''
+        return [(address, address + len(memory)) for address, memory in self.segments]
+
+
     #   def writefile(self):
     #     ''' Write the memory to the given output hex file '''
     #     currentbegin = self.beginaddress
@@ -66,18 +146,60 @@ class HexFile(object):
     #     outfile.close()
 
 
+    def _memoryend(self, address):
+        ''' end of the data in the memory (flash, EEPROM, ..) of address '''
+        border = MEMORIES[bisect_right(MEMORIES, address)] if address < MEMORIES[-1] else None
+        index = (bisect_left(self._starts, border) if border is not None else len(self._starts)) - 1
+        if index < 0:
+            return 0
+        return self._starts[index] + len(self.segments[index][1])
+
+
     def getmemoryportion(self, startaddress, size):
-        ''' return a portion of the memory '''
-        outp = []
-        if (startaddress < self.beginaddress) or \
-           (startaddress > self.endaddress):
-            return outp
-        if (startaddress + size) > self.endaddress :
-            size = self.endaddress - startaddress
-
-        for i in range(size):
-            outp.append( self.localmemory[i+startaddress] )
-        return outp
+        ''' return a portion of the memory (up to the end of the image in its
+            memory; outside the segments the memory is erased: 0xFF), as a
+            read-only memoryview (bytes-like, e.g. for serial.write)
+        '''
+        end = min(startaddress + size, self._memoryend(startaddress))
+        if startaddress >= end:
+            return memoryview(b'')
+        index = bisect_right(self._starts, startaddress) - 1
+        if index >= 0:
+            start, memory = self.segments[index]
+            if end <= start + len(memory):      # in one segment: no copy
+                return memoryview(memory).toreadonly()[startaddress - start:end - start]
+        portion = bytearray(b'\xff' * (end - startaddress))
+        for start, memory in self.segments[max(index, 0):bisect_left(self._starts, end)]:
+            first = max(start, startaddress)
+            last = min(start + len(memory), end)
+            if first < last:
+                portion[first - startaddress:last - startaddress] = \
+                    memoryview(memory)[first - start:last - start]
+        return memoryview(portion).toreadonly()
+
+
+    def eeprom(self):
+        ''' The EEPROM contents of the image, from EEPROM address 0 (empty without) '''
+        return self.getmemoryportion(EEPROM, self._memoryend(EEPROM) - EEPROM)
+
+
+    def pages(self, pagesize, begin = FLASH, end = SRAM):
+        ''' The numbers of the pages with data: touched by a segment and
+            not completely erased (0xFF), in address order; of the flash by
+            default (begin and end give another memory)
+        '''
+        touched = set()
+        for first, last in self.ranges:
+            first, last = max(first, begin), min(last, end)
+            if first < last:
+                touched.update(range(first // pagesize, (last - 1) // pagesize + 1))
+        erased = b'\xff' * pagesize
+        result = []
+        for page in sorted(touched):
+            portion = self.getmemoryportion(page * pagesize, pagesize)
+            if portion != erased[:len(portion)]:
+                result.append(page)
+        return result
 
 
 #------------------------------------------------------
@@ -7,15 +7,17 @@ Contains the main configuration startup and starts all elements
 '''
 
 
+import os
 import sys
-import time
 #import ctypes
+import threading
 import traceback
 
 from gui import GuiBuilder
 from measuring import Measure, getDeviceList
 from bootld import Bootload
 
+RECORDDIR = os.path.join(os.path.expanduser('~'), 'MilliPillar3')   # recordings of the pulses
 
 class Application(object):
     ''' Contains the LRC application '''
@@ -23,6 +25,9 @@ class Application(object):
         ''' Application (root) object constructor '''
         self._guiBuilder = None
         self.Meas = None
+        self._flasher = None                    # thread of the running flash
+        self._cancel = threading.Event()
+        self.readytimes = {}                    # port: boot-to-ready times (s) of its device
 
     def getDevice(self):
         ''' try to find the device '''
@@ -30,19 +35,50 @@ class Application(object):
             self.Meas.getDevice()
 
     def doReset(self, fileName, comport):
-        ''' request for a reset and boot loading '''
-        if fileName == '':
-            return
-        if self.Meas:
-            self.Meas.stop()
-        time.sleep(0.2)
-        del self.Meas
+        ''' request for a reset and boot loading
+            The flash runs in the background (see _flashing); the window gets its
+            progress through mw.flashMessage and the result through mw.flashEnded.
+            Returns False when nothing is started (no file, or a flash is running)
+        '''
+        if fileName == '' or self.flashing():
+            return False
+        self._cancel.clear()
+        self._flasher = threading.Thread(target=self._flashing, args=(fileName, comport),
+                                         name="Stimulator-flasher", daemon=True)
+        self._flasher.start()
+        return True
+
+
+    def flashing(self):
+        ''' a flash is running '''
+        return self._flasher is not None and self._flasher.is_alive()
+
+
+    def cancelFlash(self):
+        ''' stop the running flash before the next page '''
+        self._cancel.set()
+
+
+    def _flashing(self, fileName, comport):
+        ''' flasher thread: stop the measurement, flash and start the measurement again '''
+        mw = self._guiBuilder.mw
+        result = 1
+        meas = self.Meas
         self.Meas = None
-        flasher = Bootload(fileName, comport)
-        flasher.start_cl(self._guiBuilder.mw.UpdateScrStatus)
-        del flasher
-        time.sleep(2)   #wait for startup
-        self._makeNewMeas(comport)
+        try:
+            if meas:
+                meas.stop()
+                if meas.is_alive():     # not started when the port did not open
+                    meas.join(1.0)      # the port is closed at the end of the thread
+            flasher = Bootload(fileName, comport, cancelevent=self._cancel)
+            result = flasher.start_cl(lambda text, Recv = None: mw.flashMessage.emit(text))
+            del flasher
+        except:
+            # port or file not present: the measurement starts again anyway
+            traceback.print_exc()
+            mw.flashMessage.emit('Flashing not succeeded')
+        self._makeNewMeas(comport)     # the device is asked when it is ready
+        mw.flashEnded.emit(result)
 
 
     def setPort(self, comport):
@@ -50,7 +86,8 @@ class Application(object):
         '''
         if self.Meas:
             self.Meas.stop()
-        time.sleep(0.2)
+            if self.Meas.is_alive():    # not started when the port did not open
+                self.Meas.join(1.0)     # the port is closed at the end of the thread
         del self.Meas
         self.Meas = None 
         self._makeNewMeas(comport)
@@ -60,8 +97,9 @@ class Application(object):
         ''' make a new instance for the comport measurement thread
         '''
         self.Meas = Measure(port=comport)   # start again and read settings
-        self.Meas.setDsp(self._guiBuilder.mw.UpdateScrStatus)
-        self._guiBuilder.mw.get_initial_data()
+        self.Meas.setDsp(self._guiBuilder.mw.postSerial)
+        self.Meas.setRecordDirectory(RECORDDIR, self._guiBuilder.mw.calibration.parameters)
+        self._guiBuilder.mw.queryInitialData()
 
 
     def calibrate(self, value):
@@ -77,8 +115,23 @@ class Application(object):
             traceback.print_exc()
 
     def sendMsg(self, txt):
-        ''' give a command to th device '''
-        self.Meas.SendRequest(txt)
+        ''' give a command to th device (not during a flash) '''
+        if self.Meas:
+            self.Meas.SendRequest(txt)
+
+    def request(self, txt):
+        ''' give a command to the device; returns a Future for the response line '''
+        return self.Meas.request(txt)
+
+    def waitReady(self):
+        ''' wait for the device to answer; returns the version line or None
+            The boot-to-ready time is kept per port (readytimes)
+        '''
+        meas = self.Meas
+        version = meas.waitReady()
+        if meas.readytime is not None:
+            self.readytimes.setdefault(meas.deviceName, []).append(meas.readytime)
+        return version
 
 
     def getversion(self):
@@ -92,13 +145,16 @@ class Application(object):
         self.Meas = Measure(port=comlist[preferred])
         #At this point other subthreads already started so we only start the GUI main thread
         self._guiBuilder = GuiBuilder( self )
-        self.Meas.setDsp(self._guiBuilder.mw.UpdateScrStatus)
+        self.Meas.setDsp(self._guiBuilder.mw.postSerial)
+        self.Meas.setRecordDirectory(RECORDDIR, self._guiBuilder.mw.calibration.parameters)
         self._guiBuilder.mw.setComlist(comlist, preferred) # this also gets initial data
         self._guiBuilder.start()
 
     def stop(self):
         ''' Stop all internal stuff '''
-        self.Meas.stop()
+        self._cancel.set()
+        if self.Meas:
+            self.Meas.stop()
 
 
 def main():
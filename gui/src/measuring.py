@@ -13,16 +13,50 @@ import traceback
 import time
 import threading
 from threading import Thread
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from collections import deque
+import queue
+import selectors
 import serial
 import serial.tools.list_ports
 import os
 
+from pulsebuffer import PulseBuffer
+from protocol import parse, PROMPT, VERSION, SERIAL, STATUS, VOLTAGES, TIMINGS, WRITTEN, \
+                     MeasurementEvent, StatusEvent, SettingsEvent
+from recorder import Recorder
+from recordfile import NOSETTINGS, NOCALIBRATION
+
 RETRYCOUNT = 3
-MAXCHECKDISCONNECTED = 1000     # number of polling times to try a reconnect (--> 5 sec)
+RECONNECTMIN = 0.1              # first wait (s) before reopening a lost port
+RECONNECTMAX = 5.0              # the wait doubles after every failed try up to this
+STARTUPTIME = 3.0               # maximal time (s) for the device to answer after connecting (reset)
+READYWAIT = 1.5                 # s; wait for the banner or prompt of a reset device before asking
+READYMARKS = (PROMPT.encode(), VERSION.encode())   # prompt and banner: the firmware is running
+RETRYTIME = 0.1                 # repeat the version request while the device is starting up
+QUERYTIME = 1.0                 # maximal time (s) for the answers on the state queries
 ESC = 0x1B
 LF = 0x0A
 CR = 0x0D
 
+SPURIOUS = bytes(range(128, 256))   # characters above 127 are dropped from received lines
+COMBINETIME = 0.002                 # commands queued within 2 ms are sent in one write
+MAXWRITESIZE = 96                   # maximal combined write (receive buffer of the device)
+
+# The (last) response line of the commands that give an answer; key: first 2 characters
+RESPONSES = {
+    've': VERSION,
+    'sn': SERIAL,
+    'gs': STATUS,
+    're': STATUS,
+    'nr': STATUS,
+    'ru': STATUS,
+    'of': STATUS,
+    'ss': TIMINGS,
+    'wr': WRITTEN,
+}
+SETTINGCOMMANDS = ('sv', 'st')                  # change the settings (see SendRequest)
+
 
 CMD_CALSET = 3
 CMD_CALREAD = 4
@@ -31,14 +65,16 @@ CMD_CALREAD = 4
 def getDeviceList():
     ''' make a list of all serial ports in the system and give the port
         with USB as preferred
+        Ports named in the environment variable STIMULATOR_PORTS (e.g. an emulator)
+        come first and are preferred.
     '''
     ports = serial.tools.list_ports.comports()
     # 'com_list' contains list of all com ports
 
-    com_list = []
-    index = 0
+    com_list = [p for p in os.environ.get('STIMULATOR_PORTS', '').split(os.pathsep) if p]
+    index = len(com_list)
     preferred = 0
-    pref_found = False
+    pref_found = index > 0
 
     for p in ports:
         com_list.append(p.device)
@@ -47,6 +83,32 @@ def getDeviceList():
             pref_found = True
         index += 1
     return (com_list, preferred)
+
+
+def openPort(port, baudrate, timeout = 0.01):
+    ''' One try to open the serial port with the stimulator settings (8N1, no handshake)
+        serial_for_url also accepts 'loop://' and 'socket://' for simulated devices
+    '''
+    return serial.serial_for_url(port, baudrate=baudrate, bytesize=serial.EIGHTBITS,
+                                 parity=serial.PARITY_NONE, rtscts=False, xonxoff=False,
+                                 timeout=timeout)
+
+
+def frameLines(rxbuffer):
+    ''' Take all complete (CR-ended) lines out of the received bytearray
+        Each line is decoded once; spurious characters (>127) are dropped.
+        The incomplete remainder stays in the buffer for the next read.
+    '''
+    lines = []
+    start = 0
+    end = rxbuffer.find(CR)
+    while end >= 0:
+        lines.append(rxbuffer[start:end + 1].translate(None, SPURIOUS).decode('ascii'))
+        start = end + 1
+        end = rxbuffer.find(CR, start)
+    if start:
+        del rxbuffer[:start]
+    return lines
             
 
 
@@ -56,8 +118,11 @@ class Measure(Thread):  #pylint: disable=E1101
     '''
     TIMEDELAY = 0.005  # every 5ms a update polling time between measurements
 
-    def __init__(self, port, baudrate = 38400):
-        ''' Constructor '''
+    def __init__(self, port, baudrate = 38400, eventwait = True):
+        ''' Constructor
+            eventwait: block on the port (select/poll) instead of polling every TIMEDELAY,
+                       where the platform supports it (not on Windows or simulated ports)
+        '''
         Thread.__init__( self, target=self.read_serial)
         self.setName("Stimulator-serial")
 
@@ -66,8 +131,32 @@ class Measure(Thread):  #pylint: disable=E1101
         self.setDaemon(True)
         self._lock = threading.Lock()
         self._pollingtime = Measure.TIMEDELAY
-        self._stop = False
+        self._stopevent = threading.Event()
+        self.baudrate = baudrate
+        self.expected = {}                              # last reported status and settings lines
+        self._reported = {}                             # their events (protocol), by field
+        self.outages = []                               # (begin time, duration in s) per lost connection
+        self.readytime = None                           # s from connecting until the first prompt/banner/answer
+        self._ready = threading.Event()
+        self._connecttime = time.monotonic()
+        self.pulses = PulseBuffer()                     # the measurements of the last pulses
+        self._rxtime = 0.0                              # arrival time of the last read
+        self.recorddirectory = None                     # where to record; None: no recording
+        self.calibration = NOCALIBRATION                # stored with the recordings
+        self.recorder = None                            # running while the device reports recording
+        self._recordlock = threading.Lock()             # _setRecording from several threads
         self.receivemsg = ''
+        self._rxbuffer = bytearray()                    # received bytes, not yet a complete line
+        self._selector = None                           # event driven waiting on the port
+        self._wakeup = None                             # self-pipe to stop the waiting
+        self._portfd = None                             # file descriptor registered for waiting
+        self._pending = {}                              # response prefix: deque of waiting futures
+        self._writequeue = queue.Queue()                # encoded commands for the writer thread
+        self._writer = Thread(target=self._writeloop, name="Stimulator-writer", daemon=True)
+        self.writecount = 0                             # statistics of the writer
+        self.writebytes = 0
+        self.commandcount = 0
+        self.maxqueuedepth = 0
         self.bus = None
         ''' Try to open the serial port
         '''
@@ -79,10 +168,7 @@ class Measure(Thread):  #pylint: disable=E1101
         while retry < maxretry and self.bus == None:
             try:
                 # print("Serial Try opening: " + self.deviceName)
-                bytesize = serial.EIGHTBITS
-                parity = serial.PARITY_NONE
-                self.bus = serial.Serial(self.deviceName, baudrate=baudrate, bytesize=bytesize,
-                                    parity=parity, rtscts=False, xonxoff=False, timeout=0.01 )
+                self.bus = openPort(self.deviceName, self.baudrate)
                 #Note: on the (Beckhoff) virtual serial ports a timeout of zero is not allowed!!!!
             except:
                 #All exceptions are trapped: not only serial, but also 'os' (wrong port name, etc)
@@ -97,48 +183,342 @@ class Measure(Thread):  #pylint: disable=E1101
         if self.bus.isOpen():
             self.bus.close()
         self.bus.open()
+        self._connecttime = time.monotonic()            # opening the port resets the board (DTR)
         self.connected = True
+        if eventwait:
+            self._setupEventWait()
+        self._writer.start()
         self.start()    # start the thread
 
+
+    def _setupEventWait(self):
+        ''' Register the port and a self-pipe for waiting with select/poll
+            Without a file descriptor for the port the polling is kept
+        '''
+        try:
+            portfd = self.bus.fileno()
+        except:     # no fileno on Windows and on the simulated ports
+            return
+        self._wakeup = os.pipe()
+        self._portfd = portfd
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(portfd, selectors.EVENT_READ)
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ)
+        self.bus.timeout = 0        # reads after the wakeup may not block
+
+
+    def _waitforinput(self):
+        ''' Wait until the port has something to read (or the thread is stopped) '''
+        if self._selector is None:
+            time.sleep(self._pollingtime)  # wait  for speedy stopping
+            return
+        for key, _events in self._selector.select():
+            if key.fd == self._wakeup[0]:
+                os.read(self._wakeup[0], 64)
+
+
     def read_serial(self):
         ''' 
-            This is the main thread, running on a time-element of TIMEDELAY second. 
+            This is the main thread; when there is nothing received it waits on the port,
+            or (without event waiting) runs on a time-element of TIMEDELAY second.
+            A lost connection is supervised: the port is reopened with a growing wait.
         '''
-        count = 0
-        
-        while not self._stop:
+        while not self._stopevent.is_set():
             if self.connected and self.getdata():
                 self.checkdata()
-            if not self.connected:
-                count += 1
-                if count > MAXCHECKDISCONNECTED:
-                    count = 0
-                    # self.tryreconnect()        # Try to reconnect to the port TODO!
-
-            time.sleep(self._pollingtime)  # wait  for speedy stopping
+                continue                    # drain again before sleeping
+            if self.connected:
+                self._waitforinput()
+            else:
+                self._supervise()
         try:
             self.bus.close()        # if stopped, close the serial port
         except:
             pass
-        
+        if self._selector:
+            self._selector.close()
+            with self._lock:
+                os.close(self._wakeup[0])
+                os.close(self._wakeup[1])
+                self._wakeup = None
+
+
+    def _supervise(self):
+        ''' The connection is lost: reopen the port with exponential backoff,
+            then restore the state in the background
+        '''
+        begin = time.time()
+        lost = time.monotonic()
+        expected = dict(self.expected)
+        if self.dspfunction:
+            self.dspfunction('Connection lost; reconnecting %s' % self.deviceName)
+        backoff = RECONNECTMIN
+        while not self._stopevent.wait(backoff):
+            if self.tryreconnect():
+                duration = time.monotonic() - lost
+                self.outages.append((begin, duration))
+                Thread(target=self._restore, args=(expected, duration),
+                       name="Stimulator-restore", daemon=True).start()
+                return
+            backoff = min(2 * backoff, RECONNECTMAX)
+
+
+    def tryreconnect(self):
+        ''' Try to open the port again; returns True when connected '''
+        if self._portfd is not None:
+            self._selector.unregister(self._portfd)
+            self._portfd = None
+        try:
+            self.bus.close()
+        except:
+            pass
+        try:
+            self.bus = openPort(self.deviceName, self.baudrate)
+            if self._selector:
+                self._portfd = self.bus.fileno()
+                self._selector.register(self._portfd, selectors.EVENT_READ)
+                self.bus.timeout = 0
+        except:
+            return False
+        del self._rxbuffer[:]
+        self.expected.clear()           # the device may have rebooted: only new answers count
+        self._reported.clear()
+        self.readytime = None
+        self._ready.clear()
+        self._connecttime = time.monotonic()
+        self.connected = True
+        return True
+
+
+    def _restore(self, expected, duration):
+        ''' After a reconnect: run the initial queries again and restore the
+            run/record state and settings when the device reports otherwise.
+            The settings go first and are read back: a device that rebooted to
+            its EEPROM defaults does not pulse with the wrong settings.
+        '''
+        if self.waitReady() is None:
+            if self.dspfunction:
+                self.dspfunction('Reconnected after %.1f s; no answer, state not restored' % duration)
+            return
+        answered = self._query('ss', 'gs')
+        settings = []
+        for prefix, command in ((VOLTAGES, 'sv'), (TIMINGS, 'st')):
+            if prefix in expected and self.expected.get(prefix) != expected[prefix]:
+                settings.append('%s %s' % (command, expected[prefix][len(prefix):].replace(' ', '')))
+        for command in settings:
+            self._sendmsg(command + '\n\r')   # read back once below (not per command)
+        if settings:
+            answered = self._query('ss')
+        confirmed = answered and all(self.expected.get(prefix) == expected[prefix]
+                                     for prefix in (VOLTAGES, TIMINGS) if prefix in expected)
+        commands = []
+        if STATUS in expected and STATUS in self.expected:
+            want = [flag != '00' for flag in expected[STATUS][len(STATUS):].split()]
+            have = [flag != '00' for flag in self.expected[STATUS][len(STATUS):].split()]
+            if want[0] != have[0]:
+                commands.append('re' if want[0] else 'nr')
+            if want[1] != have[1] and (confirmed or not want[1]):
+                commands.append('ru' if want[1] else 'of')
+        for command in commands:
+            self.SendRequest(command)
+        if self.dspfunction:
+            state = '; state restored' if settings or commands else ''
+            if not confirmed:
+                state = '; settings not restored, not running'
+            elif STATUS in expected and STATUS not in self.expected:
+                state = '; no status, state not restored'
+            self.dspfunction('Reconnected after %.1f s%s' % (duration, state))
+
+
+    def _query(self, *requests):
+        ''' Send the requests and wait for their answers (QUERYTIME); the unanswered
+            ones are cancelled, so a lost answer does not go to a later request.
+            True when all were answered
+        '''
+        _, notdone = wait([self.request(reqtype) for reqtype in requests], timeout=QUERYTIME)
+        for future in notdone:
+            future.cancel()
+        return not notdone
+
+
+    def waitReady(self, timeout = STARTUPTIME):
+        ''' Wait until the device is ready and ask its version (with the echo off).
+            A device that is reset by connecting prints its prompt/banner as soon as it
+            runs: this is awaited (up to READYWAIT, or until measurements arrive) without
+            sending anything into the bootloader. Then the version request is repeated
+            until the device answers. Returns the version line, None without an answer.
+            readytime gets the time from connecting until the first prompt, banner or
+            version answer.
+        '''
+        deadline = time.monotonic() + timeout
+        quiet = time.monotonic() + min(timeout, READYWAIT)
+        while not self._ready.wait(RETRYTIME):
+            if time.monotonic() > quiet or self._stopevent.is_set():
+                break
+        versions = []
+        done = set()
+        while not done:
+            if time.monotonic() > deadline or self._stopevent.is_set():
+                return None
+            self.SendRequest('eo')
+            versions.append(self.request('ve'))
+            done, _ = wait(versions, timeout=RETRYTIME, return_when=FIRST_COMPLETED)
+        for future in versions:
+            future.cancel()             # the later versions are not needed
+        if self.dspfunction and self.readytime is not None:
+            self.dspfunction('Device ready after %.2f s' % self.readytime)
+        return done.pop().result()
+
+
+    def _checkReady(self):
+        ''' The first prompt, banner or version answer after connecting: the device runs '''
+        if any(self._rxbuffer.find(mark) >= 0 for mark in READYMARKS):
+            self.readytime = time.monotonic() - self._connecttime
+            self._ready.set()
+
 
     def setDsp(self, statusf):
-        ''' set the connection to the display '''
+        ''' set the connection to the display: statusf(text, Recv = line, Event = event)
+            for every received line (Event: parsed by protocol), statusf(text) for messages
+        '''
         self.dspfunction = statusf
 
 
     def stop(self):
         ''' Stopping this thread '''
-        self._stop = True
+        self._stopevent.set()
+        self._writequeue.put(None)              # end the writer after the queued commands
+        self._setRecording(False)
+        with self._lock:
+            if self._wakeup:
+                os.write(self._wakeup[1], b'x')    # wake up the waiting thread
+            pending = self._pending
+            self._pending = {}
+        for waiting in pending.values():
+            for future in waiting:
+                future.cancel()
 
 
     def SendRequest(self, reqtype):
         ''' Send a request message
+            New settings (sv, st) are read back with 'ss': the recording gets them
         '''
         data = reqtype + '\n\r'
         self._sendmsg(data)
+        if reqtype[:2].lower() in SETTINGCOMMANDS and reqtype[2:].strip():
+            self._sendmsg('ss\n\r')
  
 
+    def request(self, reqtype):
+        ''' Send a request message; returns a Future which gets the (stripped) response line
+            Commands without a response (see RESPONSES) are resolved with None when sent.
+            Requests with the same response are resolved in order of sending.
+        '''
+        future = Future()
+        prefix = RESPONSES.get(reqtype[:2].lower())
+        if prefix is None:
+            self.SendRequest(reqtype)
+            future.set_result(None)
+            return future
+        with self._lock:
+            self._pending.setdefault(prefix, deque()).append(future)
+        self.SendRequest(reqtype)
+        return future
+
+
+    def _storePulse(self, event):
+        ''' Keep the 12 ADC values of a measurement in the pulse buffer '''
+        self.pulses.append(self._rxtime, event.values)
+        recorder = self.recorder        # once: _setRecording may clear it on another thread
+        if recorder:
+            recorder.add(self._rxtime, event.values)
+
+
+    def _track(self, event, text):
+        ''' Keep the last reported status and settings (line and event) '''
+        self.expected[event.field] = text
+        self._reported[event.field] = event
+        if event.field == STATUS:
+            self._setRecording(self._recordFlag())
+        elif event.field == TIMINGS and self.recorder is None and self._recordFlag():
+            self._setRecording(True)    # it waited for the settings
+
+
+    def _recordFlag(self):
+        ''' the device reports recording '''
+        status = self._reported.get(STATUS)
+        return status is not None and status.recording != 0
+
+
+    def setRecordDirectory(self, directory, calibration = NOCALIBRATION):
+        ''' Record the pulses in this directory while the device reports recording
+            (by the RE command or the record button); None: no recording
+            calibration: (zero, gain) for current, full and tissue voltage, for the file header
+        '''
+        self.recorddirectory = directory
+        self.calibration = calibration
+        self._setRecording(directory is not None and self._recordFlag())
+
+
+    def getSettings(self):
+        ''' The last reported settings: ((V1, V2), (T0, T1, T2, T3, T4)) in device units '''
+        voltages = self._reported.get(VOLTAGES)
+        timings = self._reported.get(TIMINGS)
+        if voltages is None or timings is None:
+            return NOSETTINGS
+        return (voltages.voltages, timings.timings)
+
+
+    def _setRecording(self, recording):
+        ''' Start or stop the recorder on a change of the reported record flag
+            (serial thread, and the callers of stop and setRecordDirectory).
+            The recording starts when the settings are known (asked with 'ss');
+            every segment gets the settings of that moment.
+        '''
+        started = ask = False
+        with self._recordlock:
+            if recording and self.recorder is None and self.recorddirectory:
+                if self.getSettings() == NOSETTINGS:
+                    ask = True              # _track starts it on the answer
+                else:
+                    self.recorder = Recorder(self.recorddirectory,
+                                             prefix='MilliPillar_%s' % ''.join(c for c in self.deviceName if c.isalnum()),
+                                             settings=self.getSettings, calibration=self.calibration)
+                    self.recorder.start()
+                    started = True
+            elif not recording and self.recorder:
+                self.recorder.stop()
+                self.recorder = None
+        if ask and not self._stopevent.is_set():
+            self.SendRequest('ss')
+        if started and self.dspfunction:
+            self.dspfunction('Recording in %s' % self.recorddirectory)
+
+
+    def _resolve(self, event, text):
+        ''' Give a received line to the oldest request waiting for it
+            (by the field of its event; other lines by their text)
+        '''
+        with self._lock:
+            prefix = event.field
+            if prefix not in self._pending:
+                for prefix in self._pending:
+                    if text.startswith(prefix):
+                        break
+                else:
+                    return
+            waiting = self._pending[prefix]
+            future = None
+            while waiting and future is None:
+                future = waiting.popleft()
+                if not future.set_running_or_notify_cancel():
+                    future = None       # cancelled: the answer is for the next one
+            if not waiting:
+                del self._pending[prefix]
+        if future:
+            future.set_result(text)
+
+
     def readCalibrations(self, offset): #TODO!
         ''' Read the calibration value according to the current mode and offset '''
         if not self.setCommandbuffer(CMD_CALREAD):
@@ -176,49 +556,102 @@ class Measure(Thread):  #pylint: disable=E1101
 
 
     def _sendmsg(self, cv_msg):
-        '''Send the complete message through the serial port
+        '''Queue the complete message for sending through the serial port
         '''
         
         if self.bus != None:
-            self.bus.write(cv_msg.encode())
-              
+            self._writequeue.put(cv_msg.encode())
+            self.maxqueuedepth = max(self.maxqueuedepth, self._writequeue.qsize())
+
+
+    def queueDepth(self):
+        ''' Number of commands waiting for the writer '''
+        return self._writequeue.qsize()
+
+
+    def writeStatistics(self):
+        ''' Counters of the writer: writes, bytes, commands, bytes per write, maximal queue depth '''
+        return {'writes': self.writecount,
+                'bytes': self.writebytes,
+                'commands': self.commandcount,
+                'bytesperwrite': self.writebytes / self.writecount if self.writecount else 0.0,
+                'maxqueuedepth': self.maxqueuedepth}
+
+
+    def _writeloop(self):
+        ''' Writer thread: serializes all callers and combines the commands queued
+            within COMBINETIME of each other into one write (up to MAXWRITESIZE)
+        '''
+        msg = self._writequeue.get()
+        while msg is not None:
+            data = bytearray(msg)
+            commands = 1
+            msg = self._nextmsg()
+            while msg and len(data) + len(msg) <= MAXWRITESIZE:
+                data += msg
+                commands += 1
+                msg = self._nextmsg()
+            try:
+                self.bus.write(data)
+            except:     # disconnection; the reader notices it as well
+                self.connected = False
+            self.writecount += 1
+            self.writebytes += len(data)
+            self.commandcount += commands
+            if msg == b'':
+                msg = self._writequeue.get()
+
+
+    def _nextmsg(self):
+        ''' The next queued command within COMBINETIME; b'' if there is none '''
+        try:
+            return self._writequeue.get(timeout=COMBINETIME)
+        except queue.Empty:
+            return b''
+
 
     def getdata(self):
-        ''' Try to receive from line
+        ''' Try to receive from line; takes everything that is waiting in one call
+            (or waits for one character up to the port timeout)
         '''
-        data = ''
         try:
-            data = self.bus.read(1)
+            waiting = self.bus.in_waiting
+            data = self.bus.read(waiting if waiting > 0 else 1)
         except:     # serial.SerialTimeoutException (and also disconnection)
             self.connected = False
             return False
         if len(data) == 0:
             return False
-        try:
-            self.receivemsg = self.receivemsg + data.decode("utf-8")
-        except:
-            return False    # ignore invalid characters
+        self._rxtime = time.time()
+        self._rxbuffer += data
         return True
     
       
     def checkdata(self):
-        ''' Check on received message (The data is at least 1 character long)
+        ''' Check on received messages: every complete (CR-ended) line in the buffer
+            is given to the display function
         '''
-        length = len(self.receivemsg)
-        # check on complete message
-        if ord(self.receivemsg[0]) > 127: #illegal length, spurious received character
-            self.receivemsg = self.receivemsg[1:]
-            return False
-        if ord(self.receivemsg[length-1]) != CR:
-            return False
-        else:
+        if not self._ready.is_set():
+            self._checkReady()
+        lines = frameLines(self._rxbuffer)
+        for line in lines:
             ''' This is end of msg '''
+            self.receivemsg = line
+            event = parse(line)             # the only parsing of the line
+            if isinstance(event, MeasurementEvent):
+                self._storePulse(event)
+                self._ready.set()           # running already (not reset): no readytime
+            elif isinstance(event, (StatusEvent, SettingsEvent)):
+                self._track(event, line.strip())
+            if self._pending:
+                text = line.strip()
+                if text.startswith(PROMPT):
+                    text = text[len(PROMPT):].lstrip()
+                self._resolve(event, text)
             if self.dspfunction != None:
-                if  length > 2:
-                    self.dspfunction(self.receivemsg, Recv=self.receivemsg)
+                if len(self.receivemsg) > 2:
+                    self.dspfunction(self.receivemsg, Recv=self.receivemsg, Event=event)
             else:
                 print('Serial-Received: %s' % (self.receivemsg))
-            self.receivemsg = ''
-            
-        return True
-
+        self.receivemsg = ''
+        return len(lines) > 0
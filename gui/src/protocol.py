@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+'''
+Responses of the stimulator
+---------------------------
+
+parse() turns one received line into an event object. The measurement line
+(': XX XX ..', one per pulse) is by far the most frequent and is tested
+first; the other responses are found through a dict on their first two
+characters, followed by one prefix test. Lines that are no known response
+(help text, 'Settings:', 'Writing to eeprom', ..) give a TextEvent.
+
+All values are in device units, as the firmware reports them:
+
+    Stimulator Version 3.00.00              VersionEvent('3.00.00')
+    Serial: 12                              SerialEvent('12')
+    !: 01 02                                StatusEvent(recording=1, running=2)
+    Voltage V1, V2:        25, 25           SettingsEvent(voltages=(25, 25))
+    Timings T0,T1,T2,T3,T4:1000, 50, ..     SettingsEvent(timings=(1000, 50, ..))
+    : 90 80 FF ..                           MeasurementEvent(b'\\x90\\x80\\xff..')
+
+Every event has a `field`: events of the same field replace each other on
+the screen.
+
+For recordings, replay and analysis decodeMeasurements() takes a whole
+buffer of received lines at once into an (N, 12) uint8 array.
+'''
+import numpy as np
+
+from pulsebuffer import ADCVALUES
+
+PROMPT = 'TERM>'
+MEASUREMENT = ': '
+VERSION = 'Stimulator Version'
+SERIAL = 'Serial:'
+STATUS = '!:'
+VOLTAGES = 'Voltage V1, V2:'
+TIMINGS = 'Timings T0,T1,T2,T3,T4:'
+WRITTEN = 'Writing to eeprom'       # answer on 'wr' (a TextEvent)
+
+MEASLENGTH = len(MEASUREMENT) + 3 * ADCVALUES - 1        # ': XX .. XX' without the CR
+_DIGITS = 2 + 3 * np.arange(ADCVALUES)                  # first hex digit of every value
+_HEXVALUE = np.full(256, 0xFF, dtype=np.uint8)          # character: value of the hex digit
+for _value, _digit in enumerate(b'0123456789ABCDEF'):
+    _HEXVALUE[_digit] = _HEXVALUE[ord(chr(_digit).lower())] = _value
+
+
+class TextEvent(object):
+    ''' Any other line '''
+    __slots__ = ('text',)
+    field = None
+
+    def __init__(self, text):
+        self.text = text
+
+
+class MeasurementEvent(object):
+    ''' The 12 ADC values of one pulse (auAnalogValues) '''
+    __slots__ = ('values',)
+    field = MEASUREMENT
+
+    def __init__(self, values):
+        self.values = values
+
+
+class VersionEvent(object):
+    ''' Firmware version '''
+    __slots__ = ('version',)
+    field = VERSION
+
+    def __init__(self, version):
+        self.version = version
+
+
+class SerialEvent(object):
+    ''' Serial number of the device '''
+    __slots__ = ('serial',)
+    field = SERIAL
+
+    def __init__(self, serial):
+        self.serial = serial
+
+
+class StatusEvent(object):
+    ''' Record flag and start flag (0: stopped, 1: running, 2: single shot) '''
+    __slots__ = ('recording', 'running')
+    field = STATUS
+
+    def __init__(self, recording, running):
+        self.recording = recording
+        self.running = running
+
+
+class SettingsEvent(object):
+    ''' Voltages (V1, V2) or timings (T0 .. T4); the other one is None '''
+    __slots__ = ('voltages', 'timings', 'field')
+
+    def __init__(self, voltages = None, timings = None):
+        self.voltages = voltages
+        self.timings = timings
+        self.field = VOLTAGES if timings is None else TIMINGS
+
+
+def _numbers(text):
+    ''' the comma separated decimal numbers of a settings line '''
+    return tuple(int(value) for value in text.split(','))
+
+
+def _version(text):
+    ''' Stimulator Version x.xx.xx '''
+    return VersionEvent(text[len(VERSION):].strip())
+
+
+def _serial(text):
+    ''' Serial: n '''
+    return SerialEvent(text[len(SERIAL):].strip())
+
+
+def _status(text):
+    ''' !: RR SS (hex) '''
+    recording, running = text[len(STATUS):].split()[:2]
+    return StatusEvent(int(recording, 16), int(running, 16))
+
+
+def _voltages(text):
+    ''' Voltage V1, V2: v1, v2 '''
+    voltages = _numbers(text[len(VOLTAGES):])
+    if len(voltages) != 2:
+        raise ValueError(text)
+    return SettingsEvent(voltages = voltages)
+
+
+def _timings(text):
+    ''' Timings T0,T1,T2,T3,T4: t0, .., t4 '''
+    timings = _numbers(text[len(TIMINGS):])
+    if len(timings) != 5:
+        raise ValueError(text)
+    return SettingsEvent(timings = timings)
+
+
+# first two characters: (prefix, parser)
+DISPATCH = {prefix[:2]: (prefix, parser) for prefix, parser in (
+    (VERSION, _version),
+    (SERIAL, _serial),
+    (STATUS, _status),
+    (VOLTAGES, _voltages),
+    (TIMINGS, _timings))}
+
+
+def parse(line):
+    ''' The event of one received line (with or without line ends and prompt) '''
+    text = line.strip()
+    if text[:2] == MEASUREMENT:
+        try:
+            values = bytes.fromhex(text[2:])
+        except ValueError:
+            values = b''
+        if len(values) == ADCVALUES:
+            return MeasurementEvent(values)
+        return TextEvent(text)          # damaged line
+    if text.startswith(PROMPT):
+        return parse(text[len(PROMPT):])
+    entry = DISPATCH.get(text[:2])
+    if entry and text.startswith(entry[0]):
+        try:
+            return entry[1](text)
+        except ValueError:
+            pass                        # damaged line
+    return TextEvent(text)
+
+
+def decodeMeasurements(data):
+    ''' The 12 ADC values of all complete measurement lines in a buffer of received
+        lines (bytes as read from the port or a log file), as an (N, 12) uint8 array.
+        Other and damaged lines are skipped; the lines are not split into strings.
+    '''
+    if isinstance(data, str):
+        data = data.encode('ascii', 'replace')
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if len(buffer) <= MEASLENGTH:
+        return np.zeros((0, ADCVALUES), dtype=np.uint8)
+    starts = np.flatnonzero(buffer[:-MEASLENGTH] == ord(':'))
+    starts = starts[(buffer[starts + 1] == ord(' ')) & (buffer[starts + MEASLENGTH] == ord('\r'))]
+    previous = buffer[np.maximum(starts - 1, 0)]
+    starts = starts[(starts == 0) | (previous == ord('\n')) | (previous == ord('\r'))]
+    digits = starts[:, np.newaxis] + _DIGITS
+    high = _HEXVALUE[buffer[digits]]
+    low = _HEXVALUE[buffer[digits + 1]]
+    good = ((high | low) < 16).all(axis=1) & (buffer[digits[:, 1:] - 1] == ord(' ')).all(axis=1)
+    return (high[good] << 4) | low[good]
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+'''
+Ring buffer of per-pulse measurements
+-------------------------------------
+
+Every measurement line (': XX XX ..') carries the 12 ADC values of one pulse
+(auAnalogValues in board.c: current, full voltage and tissue voltage for the
+positive pulse, the rest after it, the negative pulse and the rest after that).
+
+PulseBuffer keeps the last `capacity` pulses with their arrival time in
+preallocated NumPy arrays; memory stays constant over any run length and an
+append costs O(1). Each record is written twice (at i and i + capacity), so
+every window of at most `capacity` pulses is one contiguous slice: last() and
+since() return views into the buffer, not copies. A view of n pulses stays
+valid for (capacity - n) further appends; copy it to keep it longer.
+'''
+import threading
+
+import numpy as np
+
+ADCVALUES = 12          # 3 channels for each of 4 phases
+
+
+class PulseBuffer(object):
+    ''' Fixed capacity ring buffer of (time, 12 ADC bytes) records '''
+
+    def __init__(self, capacity = 262144):
+        ''' constructor; allocates 2 * capacity records (about 20 bytes each) '''
+        self.capacity = capacity
+        self._times = np.zeros(2 * capacity, dtype=np.float64)
+        self._adc = np.zeros((2 * capacity, ADCVALUES), dtype=np.uint8)
+        self._next = 0                  # write position (0 .. capacity-1)
+        self._count = 0                 # number of valid records (up to capacity)
+        self.total = 0                  # all appended records since the start
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        ''' number of pulses in the buffer '''
+        return self._count
+
+
+    def append(self, timestamp, values):
+        ''' Add one pulse; values is a bytes object of the 12 ADC values '''
+        with self._lock:
+            i = self._next
+            j = i + self.capacity
+            self._times[i] = self._times[j] = timestamp
+            self._adc[i] = self._adc[j] = np.frombuffer(values, dtype=np.uint8)
+            self._next = i + 1 if i + 1 < self.capacity else 0
+            self._count = min(self._count + 1, self.capacity)
+            self.total += 1
+
+
+    def last(self, count = None):
+        ''' Views (times, adc) of the last count pulses, oldest first (default: all) '''
+        with self._lock:
+            if count is None or count > self._count:
+                count = self._count
+            end = self._next + self.capacity
+            return self._times[end - count:end], self._adc[end - count:end]
+
+
+    def since(self, seconds, now = None):
+        ''' Views (times, adc) of the pulses of the last seconds (relative to now
+            or to the newest pulse)
+        '''
+        times, adc = self.last()
+        if len(times) == 0:
+            return times, adc
+        if now is None:
+            now = times[-1]
+        start = int(np.searchsorted(times, now - seconds, side='left'))
+        return times[start:], adc[start:]
+
+
+    def clear(self):
+        ''' Forget all pulses '''
+        with self._lock:
+            self._next = 0
+            self._count = 0
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''
+Recording of the pulse measurements
+-----------------------------------
+
+The Measure thread hands every pulse (arrival time and the 12 ADC values)
+to the Recorder through a bounded queue; it never waits for the disk. When
+the queue is full the pulse is counted as dropped.
+
+The Recorder thread collects the pulses in batches (up to BATCHSIZE, or
+what arrived within BATCHTIME) and writes every batch with one write,
+followed by flush and fsync: a power cut loses at most one batch.
+A new file (segment) is started every `segmenttime` seconds, and when the
+settings change: they are read when a segment is made (settings may be a
+function, e.g. Measure.getSettings), so every header has the current ones.
+
+The files are in the format of recordfile (header with the settings and
+calibration, fixed records and a sparse time index).
+'''
+import os
+import time
+import queue
+import threading
+from threading import Thread
+
+from recordfile import RecordFile, EXTENSION, NOSETTINGS, NOCALIBRATION
+
+BATCHSIZE = 512                     # maximal pulses per write
+BATCHTIME = 1.0                     # maximal time (s) a pulse waits for its write
+QUEUESIZE = 8192                    # pulses waiting for the writer
+
+
+class Recorder(Thread):
+    ''' classdocs Recorder
+    Background writer of the pulse measurements to time segmented files
+    '''
+
+    def __init__(self, directory, prefix = 'MilliPillar', segmenttime = 3600,
+                 settings = NOSETTINGS, calibration = NOCALIBRATION):
+        ''' Constructor; the recording starts with start()
+            settings and calibration are stored in the header of every segment (see recordfile);
+            settings: the tuple, or a function giving the current settings
+        '''
+        Thread.__init__(self, name="Stimulator-recorder", daemon=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.segmenttime = segmenttime
+        self.settings = settings
+        self.calibration = calibration
+        self.files = []                         # names of the written segments
+        self.recorded = 0                       # statistics
+        self.dropped = 0
+        self.writes = 0
+        self._queue = queue.Queue(QUEUESIZE)
+        self._stopevent = threading.Event()
+        self._file = None
+        self._segmentend = 0.0
+        self._segmentsettings = None            # in the header of the current segment
+
+
+    def add(self, timestamp, values):
+        ''' Queue one pulse (12 ADC bytes) for writing; never blocks '''
+        try:
+            self._queue.put_nowait((timestamp, values))
+        except queue.Full:
+            self.dropped += 1
+
+
+    def stop(self):
+        ''' End the recording after writing the queued pulses; never blocks
+            (it is called from the serial thread)
+        '''
+        self._stopevent.set()
+        try:
+            self._queue.put_nowait(None)        # wake up the writer
+        except queue.Full:
+            pass                                # busy writing: it sees the event when drained
+
+
+    def run(self):
+        ''' The writer: batch the queued pulses into single writes '''
+        running = True
+        while running:
+            try:
+                item = self._queue.get(timeout=BATCHTIME)
+            except queue.Empty:
+                running = not self._stopevent.is_set()
+                continue
+            batch = []
+            deadline = time.monotonic() + BATCHTIME
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= BATCHSIZE:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            running = item is not None and not (self._stopevent.is_set() and self._queue.empty())
+            if batch:
+                self._write(batch)
+        self._close()
+
+
+    def _write(self, batch):
+        ''' Write one batch to the segment of its (first) timestamp; crash safe '''
+        timestamp = batch[0][0]
+        if self._file is None or timestamp >= self._segmentend or \
+           self._currentSettings() != self._segmentsettings:
+            self._newSegment(timestamp)
+        self._file.append(batch)
+        self.recorded += len(batch)
+        self.writes += 1
+
+
+    def _newSegment(self, timestamp):
+        ''' Close the current file and start the next segment '''
+        self._close()
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, '%s_%s' % (
+            self.prefix, time.strftime('%Y%m%d_%H%M%S', time.localtime(timestamp))))
+        name = base + EXTENSION
+        number = 1
+        while os.path.exists(name):     # a settings change within the same second
+            number += 1
+            name = '%s_%d%s' % (base, number, EXTENSION)
+        self._segmentsettings = self._currentSettings()
+        self._file = RecordFile(name, timestamp, self._segmentsettings, self.calibration)
+        self._segmentend = timestamp + self.segmenttime
+        self.files.append(name)
+
+
+    def _currentSettings(self):
+        ''' the settings for a segment header '''
+        return self.settings() if callable(self.settings) else self.settings
+
+
+    def _close(self):
+        ''' Close the current segment '''
+        if self._file:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+'''
+Recording file format
+---------------------
+
+A recording (.rec) is a fixed size header followed by fixed size records:
+
+    header (HEADERSIZE bytes, little endian):
+        magic 'MPR3', format version, record size, index interval,
+        start time, voltages V1 V2, timings T0..T4 (as set in the device),
+        calibration: (zero, gain) for current, full voltage and tissue voltage
+    records (RECORDSIZE bytes each):
+        time (unix time, double), the 12 ADC values (auAnalogValues)
+
+Next to it the sparse time index (.idx) holds (time, record number) of every
+INDEXINTERVAL-th record. A reader maps the file (mmap) and finds any time
+range through the index and one small binary search, without reading the
+records before it; the records are given as NumPy views on the mapping.
+Only complete records are used (a crashed recording may end in a part of one);
+a missing or short index is rebuilt from the records.
+
+    with RecordReader('MilliPillar_COM3_20250101_120000.rec') as rec:
+        times, adc = rec.range(begin, end)
+'''
+import os
+import mmap
+import struct
+
+import numpy as np
+
+from pulsebuffer import ADCVALUES
+
+MAGIC = b'MPR3'
+VERSION = 1
+HEADER = struct.Struct('<4sHHId2H5H6d')
+HEADERSIZE = 128                            # the header is padded to this size
+RECORD = struct.Struct('<d12s')             # time, auAnalogValues
+RECORDSIZE = RECORD.size
+RECORDTYPE = np.dtype([('time', '<f8'), ('adc', 'u1', (ADCVALUES,))])
+INDEX = struct.Struct('<dQ')                # time, record number
+INDEXTYPE = np.dtype([('time', '<f8'), ('record', '<u8')])
+INDEXINTERVAL = 1024                        # records per index entry
+EXTENSION = '.rec'
+INDEXEXTENSION = '.idx'
+
+NOSETTINGS = ((0, 0), (0, 0, 0, 0, 0))
+NOCALIBRATION = (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+
+def indexName(filename):
+    ''' The name of the index belonging to a recording '''
+    return os.path.splitext(filename)[0] + INDEXEXTENSION
+
+
+class RecordFile(object):
+    ''' Writing of one recording (header, records and index) '''
+
+    def __init__(self, filename, starttime, settings = NOSETTINGS, calibration = NOCALIBRATION):
+        ''' Create the file with its header
+            settings: ((V1, V2), (T0, T1, T2, T3, T4)) in device units
+            calibration: (current zero, gain, full voltage zero, gain, tissue voltage zero, gain)
+        '''
+        self.filename = filename
+        self.records = 0
+        self._file = open(filename, 'wb')
+        self._index = open(indexName(filename), 'wb')
+        header = HEADER.pack(MAGIC, VERSION, RECORDSIZE, INDEXINTERVAL, starttime,
+                             *(tuple(settings[0]) + tuple(settings[1]) + tuple(calibration)))
+        self._file.write(header.ljust(HEADERSIZE, b'\0'))
+
+
+    def append(self, pulses):
+        ''' Write a batch of (time, values) pulses with one write; flushed to disk
+            (file and index) before returning, so a crash loses at most this batch
+        '''
+        batch = bytearray()
+        index = bytearray()
+        number = self.records
+        for timestamp, values in pulses:
+            if number % INDEXINTERVAL == 0:
+                index += INDEX.pack(timestamp, number)
+            batch += RECORD.pack(timestamp, values)
+            number += 1
+        self._file.write(batch)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if index:
+            self._index.write(index)
+            self._index.flush()
+            os.fsync(self._index.fileno())
+        self.records = number
+
+
+    def close(self):
+        ''' Close the recording '''
+        self._file.close()
+        self._index.close()
+
+
+class RecordReader(object):
+    ''' Random access to a recording through a memory mapping '''
+
+    def __init__(self, filename):
+        ''' Map the file and read its header and index '''
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        fields = HEADER.unpack_from(self._map, 0)
+        if fields[0] != MAGIC or fields[2] != RECORDSIZE:
+            self.close()
+            raise ValueError('%s is not a MilliPillar recording' % filename)
+        self.version = fields[1]
+        self.indexinterval = fields[3]
+        self.starttime = fields[4]
+        self.voltages = fields[5:7]
+        self.timings = fields[7:12]
+        self.calibration = fields[12:18]
+        count = (len(self._map) - HEADERSIZE) // RECORDSIZE    # complete records only
+        self.records = np.frombuffer(self._map, dtype=RECORDTYPE, count=count, offset=HEADERSIZE)
+        self.times = self.records['time']
+        self.adc = self.records['adc']
+        self.index = self._readIndex()
+
+
+    def _readIndex(self):
+        ''' The sparse index; rebuilt from the records when missing or short '''
+        needed = (len(self.records) + self.indexinterval - 1) // self.indexinterval
+        try:
+            index = np.fromfile(indexName(self.filename), dtype=INDEXTYPE)
+        except (OSError, ValueError):
+            index = np.zeros(0, dtype=INDEXTYPE)
+        if len(index) < needed:
+            index = np.zeros(needed, dtype=INDEXTYPE)
+            index['record'] = np.arange(needed) * self.indexinterval
+            index['time'] = self.times[::self.indexinterval]
+        return index[:needed]
+
+
+    def __len__(self):
+        ''' number of records '''
+        return len(self.records)
+
+
+    def __enter__(self):
+        ''' context manager: the reader itself '''
+        return self
+
+
+    def __exit__(self, *args):
+        ''' context manager: close at the end '''
+        self.close()
+
+
+    def find(self, timestamp):
+        ''' Number of the first record at or after timestamp '''
+        # the last block that starts before timestamp: equal times may straddle an index entry
+        block = int(np.searchsorted(self.index['time'], timestamp, side='left')) - 1
+        if block < 0:
+            return 0
+        begin = int(self.index['record'][block])
+        end = min(begin + self.indexinterval, len(self.records))
+        return begin + int(np.searchsorted(self.times[begin:end], timestamp, side='left'))
+
+
+    def range(self, begin, end):
+        ''' Views (times, adc) of the records with begin <= time < end '''
+        first = self.find(begin)
+        last = self.find(end)
+        return self.times[first:last], self.adc[first:last]
+
+
+    def close(self):
+        ''' Release the mapping (views on it may not be used anymore) '''
+        self.records = self.times = self.adc = None
+        try:
+            self._map.close()
+        except BufferError:
+            pass            # views still in use; the mapping is released with them
+        self._file.close()